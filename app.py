@@ -1,12 +1,10 @@
 #app.py
 
 import streamlit as st
-import tempfile
-import os
 import logging
-import pandas as pd
 import re
 import json
+import hashlib
 
 # ---------- Constants (single source of truth)
 PAGE_TITLE = "Trợ lý Chấm bài"
@@ -14,22 +12,48 @@ PAGE_ICON = "📚"
 LAYOUT = "wide"
 EDITOR_HEIGHT = 420
 DF_HEIGHT = 360
+LIST_CACHE_TTL = 30
+LLM_CACHE_MAX_ENTRIES = 32
+SUBMISSION_CACHE_TTL = 300
+OCR_CACHE_MAX_ENTRIES = 32
+TABLE_CACHE_MAX_ENTRIES = 16
+
+# Student-name guess patterns, compiled once at import
+NAME_PATTERNS = [
+    re.compile(p, re.IGNORECASE | re.UNICODE | re.VERBOSE)
+    for p in (
+        r"(Họ\s* và \s*tên|Họ\s*tên|Họ\s*-\s*tên|Họ\s*&\s*tên)\s*[:\-]\s*(.+)",
+        r"(Tên|Name)\s*[:\-]\s*(.+)",
+    )
+]
+CLASS_SPLIT_PATTERN = re.compile(r"(Lớp|Lop|Class)\s*[:\-]", re.IGNORECASE)
 
 # ---------- Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ---------- Services & DB
-from services.ocr_service import ocr
-from services.llm_service import analyze_exam, segment_submission, QuestionLite
-from database.db_manager import db
-from database.models import Exam, Submission, Question, SubmissionItem
-from services.grading_service import grade_submission, build_final_report, get_or_generate_report
-from services.solution_service import create_and_save_solution, get_solution_by_question
+# Why: pandas and the LLM/grading/solution services are imported where used so Step 1 cold start skips them
+from services.ocr_service import OCR_CONFIG_SIG, PAGE_SEPARATOR
+from database.models import Exam, Submission
 
 # ---------- App config
 st.set_page_config(page_title=PAGE_TITLE, page_icon=PAGE_ICON, layout=LAYOUT)
 
+# ---------- Shared resources (created once per process, not per rerun)
+@st.cache_resource(show_spinner=False)
+def get_db():
+    from database.db_manager import db
+    return db
+
+@st.cache_resource(show_spinner=False)
+def get_ocr():
+    from services.ocr_service import ocr
+    return ocr
+
+db = get_db()
+ocr = get_ocr()
+
 # ---------- Session State
 ss = st.session_state
 ss.setdefault("ocr_text", "")
@@ -43,62 +67,289 @@ ss.setdefault("submission_name_guess", "")
 ss.setdefault("submission_id", None)
 ss.setdefault("segmented_items", [])
 ss.setdefault("submission_editor_text", "")
+ss.setdefault("grading_results", None)  # (submission_id, List[GradingResult], pyarrow summary table)
+ss.setdefault("failed_solutions", None)  # (exam_id, question ids a solution batch did not solve)
 
 # ---------- Helpers
 def display_math_text(text: str):
     # Why: dùng 1 API thống nhất để tránh Streamlit auto-render lạ
     if text is None:
         return
+    blocks = []
     for raw in str(text).splitlines():
-        s = str(raw).rstrip()
+        s = raw.rstrip()
         if not s or s.strip().lower() == "none":
-            st.markdown("&nbsp;")  # giữ khoảng trống nhẹ, không in 'None'
+            blocks.append("&nbsp;")  # giữ khoảng trống nhẹ, không in 'None'
             continue
-        # st.markdown render được cả thường lẫn LaTeX ($/$$)
-        st.markdown(s)
+        blocks.append(s)
+    # One st.markdown call; each line stays its own paragraph so $$...$$ still renders as display math
+    st.markdown("\n\n".join(blocks))
+
+# Why: fragment so editing only reruns the editor/preview pair, not the whole page
+@st.fragment
+def editor_with_preview(text_key: str, area_key: str, heading: str, label: str, actions, fallback_key: str = None):
+    c1, c2 = st.columns([1, 1], gap="large")
+
+    with c1:
+        st.markdown(heading)
+        ss[text_key] = st.text_area(
+            label, value=ss[text_key], height=EDITOR_HEIGHT,
+            help="Inline: $x^2$, Display: $$\\frac{a}{b}$$", key=area_key
+        )
+        actions()
+
+    with c2:
+        st.markdown("**Preview (real-time)**")
+        display_math_text(ss[text_key] or (ss[fallback_key] if fallback_key else ""))
+
+def ocr_uploads(files, run_ocr) -> str:
+    # Why: hand zero-copy views of the in-memory uploads straight to OCR; no temp files, no bytes copies
+    pages = [(f.getbuffer(), f.type or "image/jpeg") for f in files]
+    try:
+        return cached_ocr(OCR_CONFIG_SIG, run_ocr.__name__, upload_hash(pages), run_ocr, pages)
+    except ValueError as e:
+        return e.args[0]
+
+def upload_hash(pages: list) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for data, mime in pages:
+        h.update(mime.encode())
+        h.update(data)
+    return h.hexdigest()
+
+# Why: re-running OCR on identical uploads is the slowest step; persisted so it survives restarts
+@st.cache_data(show_spinner=False, max_entries=OCR_CACHE_MAX_ENTRIES, persist="disk")
+def cached_ocr(config_sig: str, ocr_name: str, upload_key: str, _run_ocr, _pages: list) -> str:
+    text = _run_ocr(_pages)
+    if "" in text.split(PAGE_SEPARATOR):
+        # A page failed: return the partial text uncached so the next click retries
+        raise ValueError(text)
+    return text
 
 def extract_student_name(txt: str) -> str:
     # Why: quick guess only; teacher can edit
-    patterns = [
-        r"(Họ\s* và \s*tên|Họ\s*tên|Họ\s*-\s*tên|Họ\s*&\s*tên)\s*[:\-]\s*(.+)",
-        r"(Tên|Name)\s*[:\-]\s*(.+)",
-    ]
     lines = [l.strip() for l in txt.splitlines()[:10] if l.strip()]
     for ln in lines:
-        for pat in patterns:
-            m = re.search(pat, ln, flags=re.IGNORECASE | re.UNICODE | re.VERBOSE)
+        for pat in NAME_PATTERNS:
+            m = pat.search(ln)
             if m:
                 val = m.group(len(m.groups()))
-                val = re.split(r"(Lớp|Lop|Class)\s*[:\-]", val, flags=re.IGNORECASE)[0]
+                val = CLASS_SPLIT_PATTERN.split(val, maxsplit=1)[0]
                 return val.strip()[:60]
     return ""
 
 # ---------- DB Helpers (pick từ DB khi nhảy bước)
+# Why: sidebar runs on every rerun; lists change only on create, which clears the cache
+@st.cache_data(ttl=LIST_CACHE_TTL, show_spinner=False)
 def list_exams():
     try:
         with db.get_session() as session:
-            rows = session.query(Exam).order_by(Exam.id.desc()).all()
-            return [{"id": e.id, "name": getattr(e, "name", getattr(e, "title", f"Exam {e.id}"))} for e in rows]
+            # Why: only id/label are shown; skip hydrating original_text
+            rows = session.query(Exam.id, Exam.name).order_by(Exam.id.desc()).all()
+            return [{"id": r.id, "name": r.name or f"Exam {r.id}"} for r in rows]
     except Exception as ex:
         logger.exception("list_exams failed: %s", ex)
         return []
 
+@st.cache_data(ttl=LIST_CACHE_TTL, show_spinner=False)
 def list_submissions(exam_id: int):
     if not exam_id:
         return []
     try:
         with db.get_session() as session:
             rows = (
-                session.query(Submission)
+                session.query(Submission.id, Submission.student_name)
                 .filter(Submission.exam_id == exam_id)
                 .order_by(Submission.id.desc())
                 .all()
             )
-            return [{"id": s.id, "student_name": getattr(s, "student_name", f"Submission {s.id}")} for s in rows]
+            return [{"id": r.id, "student_name": r.student_name or f"Submission {r.id}"} for r in rows]
     except Exception as ex:
         logger.exception("list_submissions failed: %s", ex)
         return []
 
+def keep_grading_results(submission_id: int, results) -> None:
+    # Why: build the Arrow summary once per grading; reruns hand the same table to st.dataframe with no pandas hop
+    import pyarrow as pa
+    summary = pa.table({
+        "Câu": [f"{r.order_index}{r.part_label}" for r in results],
+        "Kết quả": ["✅" if r.is_correct else "❌" for r in results],
+        "Lỗ hổng": ["; ".join(r.knowledge_gaps) for r in results],
+        "Lỗi": ["; ".join(r.calculation_logic_errors) for r in results],
+    })
+    ss.grading_results = (submission_id, results, summary)
+
+def render_grading_results(results, summary):
+    """Overview metric + summary table, then one markdown blob per item (Step 5)."""
+    st.subheader("📊 Kết quả chấm chi tiết")
+    
+    # Tổng quan kết quả
+    correct_count = sum(1 for r in results if r.is_correct)
+    total_count = len(results)
+    st.metric("Tổng quan", f"{correct_count}/{total_count} câu đúng", 
+             f"{correct_count/total_count*100:.1f}%" if total_count > 0 else "0%")
+
+    # Why: one dataframe + one markdown per item instead of columns/st.write per bullet
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+    
+    # Hiển thị từng câu
+    for r in results:
+        status_icon = "✅" if r.is_correct else "❌"
+        with st.expander(f"{status_icon} Câu {r.order_index}{r.part_label} - {'ĐÚNG' if r.is_correct else 'SAI'}"):
+            gaps = "\n".join(f"- {gap}" for gap in r.knowledge_gaps) or "✅ Không có lỗ hổng kiến thức"
+            errors = "\n".join(f"- {error}" for error in r.calculation_logic_errors) or "✅ Không có lỗi tính toán/logic"
+            st.markdown(
+                f"**🧠 Lỗ hổng kiến thức:**\n\n{gaps}\n\n"
+                f"**⚠️ Lỗi tính toán & logic:**\n\n{errors}\n\n"
+                f"**💬 Nhận xét tổng quan:**\n\n{r.llm_feedback}"
+            )
+
+# Why: fragment so grading clicks only rerun this panel; results live in ss so they survive page reruns
+@st.fragment
+def grading_panel(submission_id: int):
+    from services.grading_service import (
+        grade_submission, grade_submission_batch, collect_grading_batch, cancel_grading_batch, count_llm_pairs, BATCH_THRESHOLD,
+    )
+    pending_batch = db.get_pending_grading_batch(submission_id)
+    if pending_batch:
+        st.info(f"⏳ Đang chấm qua Batch API (batch {pending_batch.batch_id}). Kết quả có thể mất vài phút đến vài giờ.")
+        col_check, col_cancel = st.columns(2)
+        if col_check.button("🔄 Kiểm tra batch", use_container_width=True):
+            try:
+                with st.spinner("Đang kiểm tra batch..."):
+                    collected = collect_grading_batch(submission_id)
+            except Exception as e:
+                st.error(f"Lỗi Batch API: {e}")
+            else:
+                if collected is None:
+                    st.info("Batch vẫn đang chạy, hãy kiểm tra lại sau.")
+                else:
+                    results, failed = collected
+                    if results:
+                        keep_grading_results(submission_id, results)
+                    if failed:
+                        labels = ", ".join(f"{q.order_index}{q.part_label or ''}" for q in failed)
+                        st.warning(f"Batch không chấm được {len(failed)} câu: {labels}. Hãy bấm chấm lại để chấm các câu này.")
+                    elif not results:
+                        st.error("Batch thất bại hoặc không có kết quả. Hãy chấm lại.")
+        # Why: a batch may take hours; cancelling brings the live grading button back
+        if col_cancel.button("✖️ Huỷ batch", use_container_width=True):
+            try:
+                cancel_grading_batch(submission_id)
+            except Exception as e:
+                st.error(f"Lỗi Batch API: {e}")
+            else:
+                st.rerun()
+    else:
+        # Why: identical answers reuse stored gradings; ticking this asks the AI again and replaces them
+        force = st.checkbox("♻️ Chấm lại từ đầu (bỏ qua kết quả chấm đã lưu)", key="force_regrade")
+        if st.button("🧮 Chấm toàn bộ bài (So sánh với lời giải chuẩn)", use_container_width=True):
+            # Why: big submissions go through the Batch API (cheaper, no per-minute rate limits), collected later
+            if count_llm_pairs(submission_id, force) >= BATCH_THRESHOLD:
+                try:
+                    with st.spinner("Đang gửi batch chấm bài..."):
+                        batch_id = grade_submission_batch(submission_id, force)
+                except Exception as e:
+                    st.error(f"Lỗi Batch API: {e}")
+                    results = None
+                else:
+                    if batch_id:
+                        st.rerun()
+                    results = []
+            else:
+                with st.spinner("Đang chấm bài với AI..."):
+                    results = grade_submission(submission_id, force)
+            if results:
+                keep_grading_results(submission_id, results)
+            elif results is not None:
+                st.info("Không có mục nào để chấm hoặc submission_id không hợp lệ.")
+
+    if ss.grading_results and ss.grading_results[0] == submission_id:
+        render_grading_results(*ss.grading_results[1:])
+
+# ---------- LLM result cache (identical input → no new LLM call across reruns and restarts)
+def text_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+def llm_config_sig() -> str:
+    from services.llm_service import LLM_CONFIG_SIG
+    return LLM_CONFIG_SIG
+
+# Why: empty (or partial) results raise so st.cache_data never stores a failed call
+@st.cache_data(show_spinner=False, max_entries=LLM_CACHE_MAX_ENTRIES, persist="disk")
+def cached_analyze_exam(config_sig: str, exam_hash: str, _exam_text: str) -> list:
+    from services.llm_service import analyze_exam
+    parsed = analyze_exam(_exam_text)
+    if not parsed:
+        raise ValueError("analyze_exam returned no questions")
+    return parsed
+
+@st.cache_data(show_spinner=False, max_entries=LLM_CACHE_MAX_ENTRIES, persist="disk")
+def cached_segment_submission(config_sig: str, questions_sig: str, submission_hash: str, _questions: list, _submission_text: str) -> dict:
+    from services.llm_service import segment_submission_batch
+    data = segment_submission_batch(_questions, _submission_text)
+    if not data.get("items") or data.get("failed_groups"):
+        # Empty or partial: return it uncached so the next click retries
+        raise ValueError(data)
+    return data
+
+# Why: Step 4 may ask for the same submission text several times per rerun
+@st.cache_data(ttl=SUBMISSION_CACHE_TTL, show_spinner=False)
+def get_submission_text(submission_id: int):
+    submission = db.get_submission_by_id(submission_id)
+    return submission.original_text if submission else None
+
+def load_submission_text(submission_id: int) -> bool:
+    text = get_submission_text(submission_id)
+    if text:
+        ss.submission_text = text
+        ss.submission_editor_text = text
+    return bool(text)
+
+# ---------- Step 2 tables (rebuilt only when the rows change)
+@st.cache_data(show_spinner=False, max_entries=TABLE_CACHE_MAX_ENTRIES)
+def parsed_questions_df(rows_sig: str, _rows: list) -> "pd.DataFrame":
+    import pandas as pd
+    return pd.DataFrame(_rows).sort_values(["order_index", "part_label"])
+
+@st.cache_data(show_spinner=False, max_entries=TABLE_CACHE_MAX_ENTRIES)
+def db_questions_df(question_ids: tuple, _questions: list) -> "pd.DataFrame":
+    import pandas as pd
+    return pd.DataFrame(
+        [
+            {
+                "order_index": q.order_index,
+                "part_label": getattr(q, "part_label", ""),
+                "difficulty": q.difficulty,
+                "knowledge_topics": q.knowledge_topics,
+                "text": q.question_text,
+            }
+            for q in _questions
+        ]
+    ).sort_values(["order_index", "part_label"])
+
+# ---------- Step 3 bulk solution generation (live progress; failures reported per question)
+def generate_and_save_solutions(targets: list) -> None:
+    from services.solution_service import generate_solutions, save_solutions
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    status_text.text(f"Đang xử lý {len(targets)} câu hỏi...")
+
+    # Why: UI updates stay on this thread while generate_solutions overlaps the LLM calls
+    generated = []
+    for done, (q, result) in enumerate(generate_solutions(targets), start=1):
+        if isinstance(result, Exception):
+            st.warning(f"Lỗi câu {q.order_index}{q.part_label or ''}: {str(result)}")
+        else:
+            generated.append(result)
+        progress_bar.progress(done / len(targets))
+    # Why: one transaction (one fsync) for the whole exam instead of one commit per question
+    if generated:
+        save_solutions(generated)
+
+    status_text.text("✅ Hoàn thành!")
+    st.success(f"Đã tạo lời giải cho {len(targets)} câu hỏi.")
+
 # ---------- Sidebar (Navigator + DB picker) — NO AUTO-APPLY ----------
 with st.sidebar:
     st.header("📋 Điều hướng nhanh")
@@ -129,9 +380,12 @@ with st.sidebar:
         if exams:
             exam_options = [f'#{e["id"]} • {e["name"]}' for e in exams]
             # Nếu đã có ss.exam_id thì chọn đúng mục đó; nếu chưa có thì vẫn chọn mục đầu (chỉ pending)
-            default_exam_idx = next((i for i, e in enumerate(exams) if e["id"] == ss.exam_id), 0)
-            chosen_exam_label = st.selectbox("Đề thi (Exam)", exam_options, index=default_exam_idx, key="pick_exam")
-            pending_exam_id = exams[exam_options.index(chosen_exam_label)]["id"]
+            exam_idx_by_id = {e["id"]: i for i, e in enumerate(exams)}
+            chosen_exam_idx = st.selectbox(
+                "Đề thi (Exam)", range(len(exams)), index=exam_idx_by_id.get(ss.exam_id, 0),
+                format_func=lambda i: exam_options[i], key="pick_exam"
+            )
+            pending_exam_id = exams[chosen_exam_idx]["id"]
         else:
             st.info("Chưa có Exam trong DB.")
 
@@ -142,9 +396,12 @@ with st.sidebar:
             if subs:
                 sub_options = [f'#{s["id"]} • {s["student_name"]}' for s in subs]
                 # Nếu đã có ss.submission_id thì giữ chọn; nếu chưa có thì đang pending ở mục đầu
-                default_sub_idx = next((i for i, s in enumerate(subs) if s["id"] == ss.submission_id), 0)
-                chosen_sub_label = st.selectbox("Bài làm (Submission)", sub_options, index=default_sub_idx, key="pick_sub")
-                pending_submission_id = subs[sub_options.index(chosen_sub_label)]["id"]
+                sub_idx_by_id = {s["id"]: i for i, s in enumerate(subs)}
+                chosen_sub_idx = st.selectbox(
+                    "Bài làm (Submission)", range(len(subs)), index=sub_idx_by_id.get(ss.submission_id, 0),
+                    format_func=lambda i: sub_options[i], key="pick_sub"
+                )
+                pending_submission_id = subs[chosen_sub_idx]["id"]
             else:
                 st.info("Exam này chưa có Submission.")
 
@@ -210,10 +467,7 @@ with st.sidebar:
             if pending_submission_id:
                 ss.submission_id = pending_submission_id
                 # Load submission original_text khi chọn submission
-                submission = db.get_submission_by_id(pending_submission_id)
-                if submission and submission.original_text:
-                    ss.submission_text = submission.original_text
-                    ss.submission_editor_text = submission.original_text
+                load_submission_text(pending_submission_id)
 
             ss.current_step = desired_step
             st.rerun()
@@ -235,16 +489,7 @@ if ss.current_step == 1:
 
         if uploaded_files and exam_name and st.button("🔍 Bắt đầu OCR", type="primary", key="start_ocr_exam"):
             with st.spinner("Đang OCR đề..."):
-                temp_paths = []
-                for f in uploaded_files:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                        tmp.write(f.getbuffer())
-                        temp_paths.append(tmp.name)
-
-                ocr_result = ocr.ocr_multiple_images(temp_paths) if len(temp_paths) > 1 else ocr.ocr_single_image(temp_paths[0])
-
-                for p in temp_paths:
-                    os.unlink(p)
+                ocr_result = ocr_uploads(uploaded_files, ocr.ocr_multiple_images_bytes)
 
                 ss.ocr_text = ocr_result
                 ss.editor_text = ocr_result
@@ -261,14 +506,7 @@ if ss.current_step == 1:
 
     if ss.ocr_text:
         st.subheader("✏️ Chỉnh sửa & 👀 Xem trước (real-time)")
-        c1, c2 = st.columns([1, 1], gap="large")
-
-        with c1:
-            st.markdown("**Editor**")
-            ss.editor_text = st.text_area(
-                "Nội dung đề (LaTeX dùng $/$$):", value=ss.editor_text, height=EDITOR_HEIGHT,
-                help="Inline: $x^2$, Display: $$\\frac{a}{b}$$", key="editor_area"
-            )
+        def exam_editor_actions():
             b1, b2, _ = st.columns([1, 1, 3])
             with b1:
                 if st.button("💾 Lưu (preview)"):
@@ -280,14 +518,15 @@ if ss.current_step == 1:
                         st.error("Vui lòng nhập Tên đề bài.")
                     else:
                         exam_id = db.create_exam(exam_name, ss.editor_text)
+                        list_exams.clear()
                         ss.exam_id = exam_id
                         ss.ocr_text = ss.editor_text
                         ss.current_step = 2
                         st.rerun()
 
-        with c2:
-            st.markdown("**Preview (real-time)**")
-            display_math_text(ss.editor_text)
+        editor_with_preview(
+            "editor_text", "editor_area", "**Editor**", "Nội dung đề (LaTeX dùng $/$$):", exam_editor_actions
+        )
 
 # ====================== STEP 2 ======================
 elif ss.current_step == 2 and ss.exam_id:
@@ -304,7 +543,10 @@ elif ss.current_step == 2 and ss.exam_id:
     with cA:
         if st.button("🚀 Phân tích đề (Gemini)", use_container_width=True):
             with st.spinner("Đang phân tích..."):
-                parsed = analyze_exam(ss.ocr_text)
+                try:
+                    parsed = cached_analyze_exam(llm_config_sig(), text_hash(ss.ocr_text), ss.ocr_text)
+                except ValueError:
+                    parsed = []
                 ss.parsed_questions = [
                     {
                         "order_index": int(p["order_index"]),                       # BÀI LỚN
@@ -319,7 +561,7 @@ elif ss.current_step == 2 and ss.exam_id:
 
     with cB:
         if ss.parsed_questions:
-            df_prev = pd.DataFrame(ss.parsed_questions).sort_values(["order_index", "part_label"])
+            df_prev = parsed_questions_df(text_hash(json.dumps(ss.parsed_questions, ensure_ascii=False)), ss.parsed_questions)
             st.dataframe(df_prev, use_container_width=True, height=DF_HEIGHT)
 
     if ss.parsed_questions:
@@ -327,18 +569,7 @@ elif ss.current_step == 2 and ss.exam_id:
         bL, bR, bN = st.columns([1, 1, 1])
         with bL:
             if st.button("💾 Lưu Questions vào DB", type="primary", use_container_width=True):
-                with db.get_session() as session:
-                    for row in ss.parsed_questions:
-                        q = Question(
-                            exam_id=ss.exam_id,
-                            question_text=row["text"],
-                            difficulty=row["difficulty"],
-                            order_index=row["order_index"],
-                            part_label=row.get("part_label", ""),
-                            knowledge_topics=json.dumps(row["knowledge_topics"], ensure_ascii=False),
-                        )
-                        session.add(q)
-                    session.commit()
+                db.create_questions(ss.exam_id, ss.parsed_questions)
                 st.success("Đã lưu danh sách câu hỏi.")
                 ss.questions_from_db = db.get_questions_by_exam(ss.exam_id)
 
@@ -352,18 +583,7 @@ elif ss.current_step == 2 and ss.exam_id:
                 st.rerun()
 
         if ss.questions_from_db:
-            df_db = pd.DataFrame(
-                [
-                    {
-                        "order_index": q.order_index,
-                        "part_label": getattr(q, "part_label", ""),
-                        "difficulty": q.difficulty,
-                        "knowledge_topics": q.knowledge_topics,
-                        "text": q.question_text,
-                    }
-                    for q in ss.questions_from_db
-                ]
-            ).sort_values(["order_index", "part_label"])
+            df_db = db_questions_df(tuple(q.id for q in ss.questions_from_db), ss.questions_from_db)
             st.markdown("**Danh sách câu hỏi (DB):**")
             st.dataframe(df_db, use_container_width=True, height=DF_HEIGHT)
 
@@ -371,10 +591,17 @@ elif ss.current_step == 2 and ss.exam_id:
 elif ss.current_step == 3 and ss.exam_id:
     st.header("Bước 3: Tạo lời giải và barem chấm điểm")
     st.info(f"📌 Exam ID: {ss.exam_id}")
+    import pandas as pd
+    from services.solution_service import (
+        create_and_save_solution, get_solutions_by_exam,
+        generate_solutions_batch, collect_solutions_batch,
+    )
+
 
     questions = db.get_questions_by_exam(ss.exam_id)
     
     if questions:
+        solutions = get_solutions_by_exam(ss.exam_id)
         st.subheader("🧠 Tạo lời giải tự động")
         
         col1, col2 = st.columns([1, 1])
@@ -396,7 +623,7 @@ elif ss.current_step == 3 and ss.exam_id:
                         st.error(f"❌ Lỗi khi tạo lời giải: {str(e)}")
         
         with col2:
-            existing_solution = get_solution_by_question(selected_question.id)
+            existing_solution = solutions.get(selected_question.id)
             if existing_solution:
                 st.markdown(f"**Lời giải câu {existing_solution['order_index']}{existing_solution['part_label'] or ''}:**")
                 
@@ -419,19 +646,48 @@ elif ss.current_step == 3 and ss.exam_id:
         col_a, col_b = st.columns([1, 1])
         with col_a:
             if st.button("🔥 Tạo lời giải cho TẤT CẢ câu hỏi", use_container_width=True):
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                
-                for i, q in enumerate(questions):
-                    status_text.text(f"Đang xử lý câu {q.order_index}{q.part_label or ''}...")
+                generate_and_save_solutions(questions)
+                ss.failed_solutions = None
+                solutions = get_solutions_by_exam(ss.exam_id)
+
+            # Why: Batch API costs ~50% less for a whole exam when the teacher can wait; collected on demand
+            pending_batch = db.get_pending_solution_batch(ss.exam_id)
+            if pending_batch:
+                st.info(f"⏳ Đang tạo lời giải qua Batch API (batch {pending_batch.batch_id}).")
+                if st.button("🔄 Kiểm tra batch lời giải", use_container_width=True):
                     try:
-                        create_and_save_solution(q.id)
-                        progress_bar.progress((i + 1) / len(questions))
+                        with st.spinner("Đang kiểm tra batch..."):
+                            collected = collect_solutions_batch(ss.exam_id)
                     except Exception as e:
-                        st.warning(f"Lỗi câu {q.order_index}{q.part_label or ''}: {str(e)}")
-                
-                status_text.text("✅ Hoàn thành!")
-                st.success(f"Đã tạo lời giải cho {len(questions)} câu hỏi.")
+                        st.error(f"Lỗi Batch API: {e}")
+                    else:
+                        if collected is None:
+                            st.info("Batch vẫn đang chạy, hãy kiểm tra lại sau.")
+                        elif any(collected):
+                            ss.failed_solutions = (ss.exam_id, [q.id for q in collected[1]])
+                            st.rerun()
+                        else:
+                            st.error("Batch thất bại hoặc không có kết quả. Hãy tạo lại.")
+            elif st.button("📦 Tạo TẤT CẢ qua Batch API (rẻ hơn, chậm hơn)", use_container_width=True):
+                try:
+                    with st.spinner("Đang gửi batch tạo lời giải..."):
+                        batch_id = generate_solutions_batch(ss.exam_id)
+                except Exception as e:
+                    st.error(f"Lỗi Batch API: {e}")
+                else:
+                    if batch_id:
+                        st.rerun()
+
+            if ss.failed_solutions and ss.failed_solutions[0] == ss.exam_id:
+                # Why: questions solved one by one since the batch no longer count as failed
+                failed = [q for q in questions if q.id in ss.failed_solutions[1] and q.id not in solutions]
+                labels = ", ".join(f"{q.order_index}{q.part_label or ''}" for q in failed)
+                if failed:
+                    st.warning(f"Batch không tạo được lời giải cho {len(failed)} câu: {labels}.")
+                if failed and st.button("🔁 Tạo lại các câu lỗi", use_container_width=True):
+                    generate_and_save_solutions(failed)
+                    ss.failed_solutions = None
+                    solutions = get_solutions_by_exam(ss.exam_id)
         
         with col_b:
             if st.button("➡️ Tiếp tục Bước 4 (Upload bài làm)", use_container_width=True):
@@ -444,7 +700,7 @@ elif ss.current_step == 3 and ss.exam_id:
         # Hiển thị bảng tổng quan các solutions
         solutions_data = []
         for q in questions:
-            sol = get_solution_by_question(q.id)
+            sol = solutions.get(q.id)
             if sol:
                 solutions_data.append({
                     "Câu": f"{sol['order_index']}{sol['part_label'] or ''}",
@@ -474,10 +730,7 @@ elif ss.current_step == 4 and ss.exam_id:
     
     # Auto load submission text nếu đã chọn submission
     if ss.submission_id and not ss.submission_text:
-        submission = db.get_submission_by_id(ss.submission_id)
-        if submission and submission.original_text:
-            ss.submission_text = submission.original_text
-            ss.submission_editor_text = submission.original_text
+        if load_submission_text(ss.submission_id):
             st.success(f"📁 Đã load bài làm từ DB (Submission #{ss.submission_id})")
     
     if ss.submission_id:
@@ -498,10 +751,8 @@ elif ss.current_step == 4 and ss.exam_id:
         with col_refresh:
             if st.button("🔄 Refresh từ DB", disabled=not ss.submission_id):
                 if ss.submission_id:
-                    submission = db.get_submission_by_id(ss.submission_id)
-                    if submission and submission.original_text:
-                        ss.submission_text = submission.original_text
-                        ss.submission_editor_text = submission.original_text
+                    get_submission_text.clear()
+                    if load_submission_text(ss.submission_id):
                         st.success("🔄 Đã refresh từ DB")
                         st.rerun()
         
@@ -532,16 +783,7 @@ elif ss.current_step == 4 and ss.exam_id:
 
             if submission_files and st.button("🔍 OCR bài làm", type="primary", key="start_ocr_submission"):
                 with st.spinner("Đang OCR bài làm..."):
-                    temp_paths = []
-                    for f in submission_files:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                            tmp.write(f.getbuffer())
-                            temp_paths.append(tmp.name)
-
-                    sub_text = ocr.ocr_submission_images(temp_paths)
-
-                    for p in temp_paths:
-                        os.unlink(p)
+                    sub_text = ocr_uploads(submission_files, ocr.ocr_submission_images_bytes)
 
                     ss.submission_text = sub_text
                     ss.submission_name_guess = extract_student_name(sub_text)
@@ -559,6 +801,8 @@ elif ss.current_step == 4 and ss.exam_id:
                         student_name=student_name.strip() or "Chưa rõ",
                         original_text=ss.submission_text
                     )
+                    list_submissions.clear()
+                    get_submission_text.clear()
                     ss.submission_id = sub_id
                     st.success(f"Đã lưu bài làm • Submission ID: {sub_id}")
                     st.rerun()
@@ -566,31 +810,20 @@ elif ss.current_step == 4 and ss.exam_id:
     st.divider()
     st.subheader("✏️ Chỉnh sửa bài làm & 👀 Xem trước (real-time)")
     if ss.submission_text:
-        c1, c2 = st.columns([1, 1], gap="large")
-
-        with c1:
-            st.markdown("**Editor (bài làm học sinh)**")
-            ss.submission_editor_text = st.text_area(
-                "Nội dung (LaTeX dùng $/$$):",
-                value=ss.submission_editor_text,
-                height=EDITOR_HEIGHT,
-                help="Inline: $x^2$, Display: $$\\frac{a}{b}$$",
-                key="submission_editor_area"
-            )
+        def submission_editor_actions():
             if st.button("💾 Lưu (preview)", key="btn_save_submission_preview"):
                 ss.submission_text = ss.submission_editor_text
-                st.success("Đã lưu bản nháp bài làm.")
+                # Why: the editor is a fragment; a full rerun refreshes everything outside it that reads submission_text
+                st.rerun()
 
-        with c2:
-            st.markdown("**Preview (real-time)**")
-            display_math_text(ss.submission_editor_text or ss.submission_text)
+        editor_with_preview(
+            "submission_editor_text", "submission_editor_area", "**Editor (bài làm học sinh)**",
+            "Nội dung (LaTeX dùng $/$$):", submission_editor_actions, fallback_key="submission_text"
+        )
     else:
         # Kiểm tra xem có submission được chọn từ sidebar không
         if ss.submission_id:
-            submission = db.get_submission_by_id(ss.submission_id)
-            if submission and submission.original_text:
-                ss.submission_text = submission.original_text
-                ss.submission_editor_text = submission.original_text
+            if load_submission_text(ss.submission_id):
                 st.success("📁 Đã load bài làm từ DB. Scroll xuống để xem.")
                 st.rerun()
             else:
@@ -601,38 +834,23 @@ elif ss.current_step == 4 and ss.exam_id:
     st.divider()
     st.subheader("✂️ Phân đoạn bài làm theo câu hỏi (LLM)")
 
-    # Chuẩn bị outline rút gọn từ Questions trong DB
     if ss.submission_id:
-        questions = db.get_questions_by_exam(ss.exam_id)
-        outline = []
-
-        # map part_label từ kết quả STEP 2 (nếu còn trong session)
-        mp = {}
-        if ss.get("parsed_questions"):
-            for r in ss.parsed_questions:
-                mp[(r["text"] or "")[:50]] = r.get("part_label", "")
-
-        for q in questions:
-            try:
-                topics = json.loads(q.knowledge_topics or "[]")
-            except Exception:
-                topics = []
-            key = (q.question_text or "")[:50]
-            outline.append(
-                QuestionLite(
-                    question_id=q.id,
-                    order_index=q.order_index,
-                    part_label=mp.get(key, ""),        # ưu tiên part_label nếu có
-                    text_short=(q.question_text or "")[:200],
-                    keywords=list(topics)[:5],
-                )
-            )
-
         if st.button("🔧 Phân đoạn bằng LLM (Skeleton approach)", use_container_width=True):
             with st.spinner("Đang phân đoạn với skeleton..."):
-                data = segment_submission(questions, ss.submission_text)
-                ss.segmented_items = data.get("items", [])
+                questions = db.get_questions_by_exam(ss.exam_id)
+                questions_sig = text_hash(repr([(q.id, q.order_index, q.part_label) for q in questions]))
+                try:
+                    data = cached_segment_submission(
+                        llm_config_sig(), questions_sig, text_hash(ss.submission_text), questions, ss.submission_text
+                    )
+                except ValueError as e:
+                    data = e.args[0]
+                # Sort once here so the editor never re-sorts on reruns
+                ss.segmented_items = sorted(data.get("items", []), key=lambda r: r["position"])
                 st.success(f"Đã phân đoạn {len(ss.segmented_items)} items từ skeleton.")
+                if data.get("failed_groups"):
+                    groups = ", ".join(map(str, data["failed_groups"]))
+                    st.warning(f"Chưa phân đoạn được BÀI {groups}: các ý này đang để trống, hãy điền tay hoặc phân đoạn lại.")
 
         if ss.segmented_items:
             st.subheader("✏️ Xem và chỉnh sửa kết quả phân đoạn")
@@ -643,11 +861,9 @@ elif ss.current_step == 4 and ss.exam_id:
             with col1:
                 st.markdown("**📝 Chỉnh sửa answer_text:**")
                 
-                # Convert to editable DataFrame
-                df_seg = pd.DataFrame(ss.segmented_items).sort_values(["position"])
-                
-                edited_df = st.data_editor(
-                    df_seg,
+                # data_editor takes and returns list-of-dicts directly (no DataFrame round-trip)
+                edited_items = st.data_editor(
+                    ss.segmented_items,
                     column_config={
                         "question_id": st.column_config.NumberColumn("Question ID", disabled=True),
                         "order_index": st.column_config.NumberColumn("Order", disabled=True), 
@@ -663,7 +879,7 @@ elif ss.current_step == 4 and ss.exam_id:
                 )
                 
                 # Update session state với data đã edit
-                ss.segmented_items = edited_df.to_dict('records')
+                ss.segmented_items = edited_items
             
             with col2:
                 st.markdown("**🔍 LaTeX Preview:**")
@@ -671,12 +887,12 @@ elif ss.current_step == 4 and ss.exam_id:
                 # Select row để preview
                 selected_row = st.selectbox(
                     "Chọn row để preview:",
-                    range(len(edited_df)),
-                    format_func=lambda x: f"Row {x+1}: {edited_df.iloc[x]['order_index']}{edited_df.iloc[x]['part_label']}"
+                    range(len(edited_items)),
+                    format_func=lambda x: f"Row {x+1}: {edited_items[x]['order_index']}{edited_items[x]['part_label']}"
                 )
                 
                 if selected_row is not None:
-                    preview_text = edited_df.iloc[selected_row]['answer_text']
+                    preview_text = edited_items[selected_row]['answer_text']
                     if preview_text and preview_text.strip():
                         st.markdown("**Preview:**")
                         with st.container():
@@ -685,18 +901,7 @@ elif ss.current_step == 4 and ss.exam_id:
                         st.info("Answer text trống")
 
             if st.button("💾 Lưu chi tiết từng ý (submission_items)", type="primary", use_container_width=True):
-                with db.get_session() as session:
-                    for it in ss.segmented_items:
-                        item = SubmissionItem(
-                            submission_id=ss.submission_id,
-                            question_id=int(it["question_id"]),
-                            order_index=int(it["order_index"]),
-                            part_label=str(it.get("part_label") or ""),
-                            position=int(it.get("position") or 1),
-                            answer_text=str(it.get("answer_text") or "").strip(),
-                        )
-                        session.add(item)
-                    session.commit()
+                db.create_submission_items(ss.submission_id, ss.segmented_items)
                 st.success("Đã lưu các ý của bài làm vào submission_items.")
 
     # Nút chuyển bước 4
@@ -710,6 +915,7 @@ elif ss.current_step == 4 and ss.exam_id:
 elif ss.current_step == 5 and ss.exam_id:
     st.header("Bước 5: Chấm bài")
     st.info(f"📌 Exam ID: {ss.exam_id}")
+    from services.grading_service import build_final_report_stream
 
     # Nếu user nhảy thẳng vào Bước 5 mà chưa có submission_id → cho chọn
     if not ss.submission_id:
@@ -717,8 +923,10 @@ elif ss.current_step == 5 and ss.exam_id:
         subs_inline = list_submissions(ss.exam_id)
         if subs_inline:
             opt_inline = [f'#{s["id"]} • {s["student_name"]}' for s in subs_inline]
-            pick_inline = st.selectbox("Chọn Submission để chấm", opt_inline, key="pick_sub_inline")
-            picked = subs_inline[opt_inline.index(pick_inline)]
+            pick_inline = st.selectbox(
+                "Chọn Submission để chấm", range(len(subs_inline)), format_func=lambda i: opt_inline[i], key="pick_sub_inline"
+            )
+            picked = subs_inline[pick_inline]
             ss.submission_id = picked["id"]
             st.rerun()
         else:
@@ -728,45 +936,7 @@ elif ss.current_step == 5 and ss.exam_id:
 
     colA, colB = st.columns([1, 1])
     with colA:
-        if st.button("🧮 Chấm toàn bộ bài (So sánh với lời giải chuẩn)", use_container_width=True):
-            with st.spinner("Đang chấm bài với AI..."):
-                results = grade_submission(int(ss.submission_id))
-            if results:
-                st.subheader("📊 Kết quả chấm chi tiết")
-                
-                # Tổng quan kết quả
-                correct_count = sum(1 for r in results if r.is_correct)
-                total_count = len(results)
-                st.metric("Tổng quan", f"{correct_count}/{total_count} câu đúng", 
-                         f"{correct_count/total_count*100:.1f}%" if total_count > 0 else "0%")
-                
-                # Hiển thị từng câu
-                for r in results:
-                    status_icon = "✅" if r.is_correct else "❌"
-                    with st.expander(f"{status_icon} Câu {r.order_index}{r.part_label} - {'ĐÚNG' if r.is_correct else 'SAI'}"):
-                        
-                        col1, col2 = st.columns([1, 1])
-                        
-                        with col1:
-                            st.markdown("**🧠 Lỗ hổng kiến thức:**")
-                            if r.knowledge_gaps:
-                                for gap in r.knowledge_gaps:
-                                    st.write(f"• {gap}")
-                            else:
-                                st.write("✅ Không có lỗ hổng kiến thức")
-                        
-                        with col2:
-                            st.markdown("**⚠️ Lỗi tính toán & logic:**")
-                            if r.calculation_logic_errors:
-                                for error in r.calculation_logic_errors:
-                                    st.write(f"• {error}")
-                            else:
-                                st.write("✅ Không có lỗi tính toán/logic")
-                        
-                        st.markdown("**💬 Nhận xét tổng quan:**")
-                        st.markdown(r.llm_feedback)
-            else:
-                st.info("Không có mục nào để chấm hoặc submission_id không hợp lệ.")
+        grading_panel(int(ss.submission_id))
 
     with colB:
         # Hiển thị báo cáo đã lưu nếu có
@@ -779,11 +949,10 @@ elif ss.current_step == 5 and ss.exam_id:
             col1, col2 = st.columns([1, 1])
             with col1:
                 if st.button("🔄 Tạo lại báo cáo", use_container_width=True):
-                    with st.spinner("Đang tạo báo cáo mới..."):
-                        report_md = build_final_report(int(ss.submission_id))
-                        if report_md.strip():
-                            st.success("✅ Đã tạo báo cáo mới")
-                            st.rerun()
+                    report_md = st.write_stream(build_final_report_stream(int(ss.submission_id)))
+                    if report_md.strip():
+                        st.success("✅ Đã tạo báo cáo mới")
+                        st.rerun()
             with col2:
                 st.download_button(
                     "⬇️ Tải báo cáo (.md)",
@@ -794,13 +963,13 @@ elif ss.current_step == 5 and ss.exam_id:
                 )
         else:
             if st.button("📝 Tạo bản chấm tổng hợp", use_container_width=True):
-                with st.spinner("Đang tạo báo cáo..."):
-                    report_md = build_final_report(int(ss.submission_id))
-                    if report_md.strip():
-                        st.success("✅ Đã tạo và lưu báo cáo")
-                        st.rerun()
-                    else:
-                        st.info("Chưa có dữ liệu chấm hoặc báo cáo rỗng.")
+                # Why: stream tokens as they arrive instead of a spinner over the whole generation
+                report_md = st.write_stream(build_final_report_stream(int(ss.submission_id)))
+                if report_md.strip():
+                    st.success("✅ Đã tạo và lưu báo cáo")
+                    st.rerun()
+                else:
+                    st.info("Chưa có dữ liệu chấm hoặc báo cáo rỗng.")
 
 # ====================== STEP 6 (OLD STEP 5): XUẤT BÁO CÁO ======================
 elif ss.current_step == 6 and ss.exam_id:
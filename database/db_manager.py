@@ -1,19 +1,39 @@
 # database/db_manager.py
 import os
-import json
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from database.models import Base, Exam, Question, Submission, Grading, SubmissionItem, QuestionSolution, SubmissionReport
+from sqlalchemy import create_engine, event, insert, inspect, text
+from sqlalchemy.orm import sessionmaker, Session, selectinload
+from database.models import Base, Exam, Question, Submission, Grading, SubmissionItem, QuestionSolution, SubmissionReport, GradingBatch, GradingCache, SolutionBatch
 
 DATABASE_PATH = "data/database.db"
+SQLITE_BUSY_TIMEOUT = 30  # seconds a writer waits for a lock before "database is locked"
+# Why: WAL lets Streamlit reruns and grading worker threads read while another thread writes
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+)
+
+def _apply_sqlite_pragmas(dbapi_conn, _record) -> None:
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
 class DatabaseManager:
     def __init__(self):
         os.makedirs("data", exist_ok=True)
-        self.engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+        self.engine = create_engine(
+            f"sqlite:///{DATABASE_PATH}",
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT},
+        )
+        event.listen(self.engine, "connect", _apply_sqlite_pragmas)
         Base.metadata.create_all(self.engine)  # create new tables if missing
+        self._create_missing_indexes()
         self._run_migrations()  # run any needed schema migrations
-        self.SessionLocal = sessionmaker(bind=self.engine)
+        # Why: helpers return ids/objects right after commit; skip the refresh SELECT expiry would trigger
+        self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
 
     def get_session(self) -> Session:
         return self.SessionLocal()
@@ -33,9 +53,42 @@ class DatabaseManager:
             session.commit()
             return sub.id
 
+    def create_questions(self, exam_id: int, rows: list) -> None:
+        mappings = [
+            {
+                "exam_id": exam_id,
+                "question_text": r["text"],
+                "difficulty": r["difficulty"],
+                "order_index": r["order_index"],
+                "part_label": r.get("part_label", ""),
+                "knowledge_topics": r["knowledge_topics"],
+            }
+            for r in rows
+        ]
+        # Why: one executemany INSERT in a single explicit transaction
+        with self.get_session() as session, session.begin():
+            session.execute(insert(Question), mappings)
+
+    def create_submission_items(self, submission_id: int, items: list) -> None:
+        mappings = [
+            {
+                "submission_id": submission_id,
+                "question_id": int(it["question_id"]),
+                "order_index": int(it["order_index"]),
+                "part_label": str(it.get("part_label") or ""),
+                "position": int(it.get("position") or 1),
+                "answer_text": str(it.get("answer_text") or "").strip(),
+            }
+            for it in items
+        ]
+        # Why: one executemany INSERT in a single explicit transaction
+        with self.get_session() as session, session.begin():
+            session.execute(insert(SubmissionItem), mappings)
+
     def get_questions_by_exam(self, exam_id: int):
         with self.get_session() as session:
-            return session.query(Question).filter(
+            # Why: grading reads q.solution for every question; one IN (...) query instead of N lookups
+            return session.query(Question).options(selectinload(Question.solution)).filter(
                 Question.exam_id == exam_id
             ).order_by(Question.order_index, Question.id).all()
 
@@ -47,33 +100,24 @@ class DatabaseManager:
 
     def get_submission_by_id(self, submission_id: int):
         with self.get_session() as session:
-            return session.query(Submission).filter(
-                Submission.id == submission_id
-            ).first()
+            return session.get(Submission, submission_id)
+
+    def _create_missing_indexes(self):
+        # Why: create_all skips tables that already exist, so their new indexes must be added explicitly
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
 
     def _run_migrations(self):
         """Run any needed database schema migrations"""
-        try:
-            with self.engine.begin() as conn:  # Use begin() for auto-commit
-                # Migration 1: Add original_text column to exams table if it doesn't exist
-                try:
-                    # Test if column exists by trying to select it
-                    conn.execute("SELECT original_text FROM exams LIMIT 1")
-                except Exception:
-                    # Column doesn't exist, add it
-                    print("Adding original_text column to exams table...")
-                    conn.execute("ALTER TABLE exams ADD COLUMN original_text TEXT")
-                    print("Migration completed: original_text column added to exams")
-                
-                # Migration 2: Check if submission_reports table exists
-                try:
-                    conn.execute("SELECT COUNT(*) FROM submission_reports LIMIT 1")
-                except Exception:
-                    # Table doesn't exist, but SQLAlchemy will create it automatically
-                    print("submission_reports table will be created by SQLAlchemy")
-        except Exception as e:
-            print(f"Migration warning: {e}")
-            # Continue even if migration fails (table might not exist yet)
+        # Why: one schema introspection instead of probing with SELECTs that fail on every boot
+        # (submission_reports and other new tables are created by create_all above)
+        exam_columns = {c["name"] for c in inspect(self.engine).get_columns("exams")}
+        if "original_text" not in exam_columns:
+            print("Adding original_text column to exams table...")
+            with self.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE exams ADD COLUMN original_text TEXT"))
+            print("Migration completed: original_text column added to exams")
 
     def save_submission_report(self, submission_id: int, report_content: str) -> int:
         with self.get_session() as session:
@@ -94,6 +138,48 @@ class DatabaseManager:
     def get_latest_report(self, submission_id: int):
         return self.get_submission_report(submission_id)
 
+    def create_grading_batch(self, submission_id: int, batch_id: str) -> int:
+        with self.get_session() as session:
+            batch = GradingBatch(submission_id=submission_id, batch_id=batch_id)
+            session.add(batch)
+            session.commit()
+            return batch.id
+
+    def get_pending_grading_batch(self, submission_id: int):
+        with self.get_session() as session:
+            return session.query(GradingBatch).filter(
+                GradingBatch.submission_id == submission_id,
+                GradingBatch.status == "pending"
+            ).order_by(GradingBatch.id.desc()).first()
+
+    def update_grading_batch_status(self, grading_batch_id: int, status: str):
+        with self.get_session() as session:
+            batch = session.get(GradingBatch, grading_batch_id)
+            if batch:
+                batch.status = status
+                session.commit()
+
+    def create_solution_batch(self, exam_id: int, batch_id: str) -> int:
+        with self.get_session() as session:
+            batch = SolutionBatch(exam_id=exam_id, batch_id=batch_id)
+            session.add(batch)
+            session.commit()
+            return batch.id
+
+    def get_pending_solution_batch(self, exam_id: int):
+        with self.get_session() as session:
+            return session.query(SolutionBatch).filter(
+                SolutionBatch.exam_id == exam_id,
+                SolutionBatch.status == "pending"
+            ).order_by(SolutionBatch.id.desc()).first()
+
+    def update_solution_batch_status(self, solution_batch_id: int, status: str):
+        with self.get_session() as session:
+            batch = session.get(SolutionBatch, solution_batch_id)
+            if batch:
+                batch.status = status
+                session.commit()
+
     def create_solution(self, question_id: int, order_index: int, part_label: str, solution_text: str, final_answer: str, reasoning_approach: str) -> int:
         with self.get_session() as session:
             solution = QuestionSolution(
@@ -108,6 +194,44 @@ class DatabaseManager:
             session.commit()
             return solution.id
 
+    def save_solutions_bulk(self, rows: list) -> list:
+        """Insert or update one QuestionSolution per row (keyed by question_id) in a single transaction."""
+        with self.get_session() as session, session.begin():
+            existing = {
+                s.question_id: s
+                for s in session.query(QuestionSolution).filter(
+                    QuestionSolution.question_id.in_([r["question_id"] for r in rows])
+                )
+            }
+            solutions = []
+            for r in rows:
+                solution = existing.get(r["question_id"])
+                if solution:
+                    for field, value in r.items():
+                        setattr(solution, field, value)
+                else:
+                    solution = QuestionSolution(**r)
+                    session.add(solution)
+                solutions.append(solution)
+            session.flush()
+            return [s.id for s in solutions]
+
+    def get_cached_gradings(self, keys: list) -> dict:
+        with self.get_session() as session:
+            return dict(session.query(GradingCache.cache_key, GradingCache.result).filter(
+                GradingCache.cache_key.in_(set(keys))
+            ))
+
+    def save_cached_gradings(self, results: dict) -> None:
+        if not results:
+            return
+        # Why: a forced regrade must overwrite the stored result for the same request
+        with self.get_session() as session, session.begin():
+            session.execute(
+                insert(GradingCache).prefix_with("OR REPLACE"),
+                [{"cache_key": key, "result": result} for key, result in results.items()],
+            )
+
     def get_solution_by_question(self, question_id: int):
         with self.get_session() as session:
             return session.query(QuestionSolution).filter(
@@ -116,7 +240,7 @@ class DatabaseManager:
 
     def update_solution(self, solution_id: int, order_index: int, part_label: str, solution_text: str, final_answer: str, reasoning_approach: str):
         with self.get_session() as session:
-            solution = session.query(QuestionSolution).filter(QuestionSolution.id == solution_id).first()
+            solution = session.get(QuestionSolution, solution_id)
             if solution:
                 solution.order_index = order_index
                 solution.part_label = part_label
@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, create_engine
+import json
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Index, create_engine
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -6,6 +8,33 @@ from datetime import datetime
 # Why: single declarative base
 Base = declarative_base()
 
+class JSONList(TypeDecorator):
+    """list[str] stored as a JSON array in TEXT; (de)serialized here so callers never json.dumps/loads."""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return json.dumps(value or [], ensure_ascii=False)
+
+    def process_result_value(self, value, dialect):
+        if not value:
+            return []
+        try:
+            return json.loads(value)
+        except ValueError:
+            return []
+
+class JSONDict(TypeDecorator):
+    """dict stored as a JSON object in TEXT."""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return json.dumps(value or {}, ensure_ascii=False)
+
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value else {}
+
 class Exam(Base):
     __tablename__ = "exams"
     id = Column(Integer, primary_key=True)
@@ -15,16 +44,18 @@ class Exam(Base):
 
     questions = relationship("Question", back_populates="exam", cascade="all, delete-orphan")
     submissions = relationship("Submission", back_populates="exam", cascade="all, delete-orphan")
+    solution_batches = relationship("SolutionBatch", back_populates="exam", cascade="all, delete-orphan")
 
 class Question(Base):
     __tablename__ = "questions"
+    __table_args__ = (Index("ix_q_exam_order", "exam_id", "order_index", "id"),)
     id = Column(Integer, primary_key=True)
     exam_id = Column(Integer, ForeignKey("exams.id"), nullable=False)
     question_text = Column(Text, nullable=False)
     difficulty = Column(Integer, default=1)
     order_index = Column(Integer, nullable=False)     # BÀI LỚN
     part_label = Column(String(32))                   # multi-level label, e.g. "1.a" or "IV.1.b"
-    knowledge_topics = Column(Text, default="[]")     # JSON string
+    knowledge_topics = Column(JSONList, default=list)
 
     exam = relationship("Exam", back_populates="questions")
     gradings = relationship("Grading", back_populates="question", cascade="all, delete-orphan")
@@ -33,6 +64,7 @@ class Question(Base):
     
 class Submission(Base):
     __tablename__ = "submissions"
+    __table_args__ = (Index("ix_sub_exam_id", "exam_id", "id"),)
     id = Column(Integer, primary_key=True)
     exam_id = Column(Integer, ForeignKey("exams.id"), nullable=False)
     student_name = Column(String(255), nullable=False)
@@ -43,9 +75,11 @@ class Submission(Base):
     gradings = relationship("Grading", back_populates="submission", cascade="all, delete-orphan")
     items = relationship("SubmissionItem", back_populates="submission", cascade="all, delete-orphan")
     reports = relationship("SubmissionReport", back_populates="submission", cascade="all, delete-orphan")
+    grading_batches = relationship("GradingBatch", back_populates="submission", cascade="all, delete-orphan")
 
 class SubmissionItem(Base):
     __tablename__ = "submission_items"
+    __table_args__ = (Index("ix_subitem_sub_pos", "submission_id", "position"),)
     id = Column(Integer, primary_key=True)
     submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=False)
     question_id = Column(Integer, ForeignKey("questions.id"), nullable=False)
@@ -59,6 +93,7 @@ class SubmissionItem(Base):
 
 class QuestionSolution(Base):
     __tablename__ = "question_solutions"
+    __table_args__ = (Index("ix_solutions_question", "question_id"),)
     id = Column(Integer, primary_key=True)
     question_id = Column(Integer, ForeignKey("questions.id"), nullable=False)
     order_index = Column(Integer, nullable=False)
@@ -72,13 +107,14 @@ class QuestionSolution(Base):
 
 class Grading(Base):
     __tablename__ = "gradings"
+    __table_args__ = (Index("ix_gradings_sub_question", "submission_id", "question_id"),)
     id = Column(Integer, primary_key=True)
     submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=False)
     question_id = Column(Integer, ForeignKey("questions.id"), nullable=False)
     
     # 3 yếu tố phân tích mới
-    knowledge_gaps = Column(Text)           # Lỗ hổng kiến thức (JSON array)
-    calculation_logic_errors = Column(Text) # Lỗi tính toán/logic (JSON array)  
+    knowledge_gaps = Column(JSONList, default=list)           # Lỗ hổng kiến thức
+    calculation_logic_errors = Column(JSONList, default=list) # Lỗi tính toán/logic
     llm_feedback = Column(Text)             # Nhận xét của LLM
     
     # Đánh giá kết quả
@@ -92,9 +128,39 @@ class Grading(Base):
 
 class SubmissionReport(Base):
     __tablename__ = "submission_reports"
+    __table_args__ = (Index("ix_reports_sub_created", "submission_id", "created_at"),)
     id = Column(Integer, primary_key=True)
     submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=False)
     report_content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.now)
     
-    submission = relationship("Submission", back_populates="reports")
\ No newline at end of file
+    submission = relationship("Submission", back_populates="reports")
+
+class GradingBatch(Base):
+    __tablename__ = "grading_batches"
+    __table_args__ = (Index("ix_grading_batches_sub_status", "submission_id", "status"),)
+    id = Column(Integer, primary_key=True)
+    submission_id = Column(Integer, ForeignKey("submissions.id"), nullable=False)
+    batch_id = Column(String(64), nullable=False)       # OpenAI Batch API id
+    status = Column(String(16), default="pending")      # pending / collected / failed / cancelled
+    created_at = Column(DateTime, default=datetime.now)
+
+    submission = relationship("Submission", back_populates="grading_batches")
+
+class SolutionBatch(Base):
+    __tablename__ = "solution_batches"
+    __table_args__ = (Index("ix_solution_batches_exam_status", "exam_id", "status"),)
+    id = Column(Integer, primary_key=True)
+    exam_id = Column(Integer, ForeignKey("exams.id"), nullable=False)
+    batch_id = Column(String(64), nullable=False)       # OpenAI Batch API id
+    status = Column(String(16), default="pending")      # pending / collected / failed
+    created_at = Column(DateTime, default=datetime.now)
+
+    exam = relationship("Exam", back_populates="solution_batches")
+
+class GradingCache(Base):
+    __tablename__ = "grading_cache"
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), nullable=False, unique=True)  # sha256 of the full grading request
+    result = Column(JSONDict, nullable=False)                    # grading_data as returned by the model
+    created_at = Column(DateTime, default=datetime.now)
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-import os
 import json
+import hashlib
 from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
-from dotenv import load_dotenv
-from openai import OpenAI
+from utils.openai_batch import cancel_chat_batch, fetch_chat_batch, submit_chat_batch
+from utils.openai_client import get_openai_client
+from utils.retry import with_backoff
+from utils.throttle import throttled
 
 # Database
 from database.db_manager import db
@@ -19,8 +22,16 @@ from services.solution_service import get_solution_by_question
 MODEL_GRADING = "gpt-4.1-mini-2025-04-14"
 COMMENT_MODEL = "gpt-4o-mini"
 TEMPERATURE = 0.1
-CTX_MAX_CHARS_QUESTION = 1200
-CTX_MAX_CHARS_ANSWER = 1200
+# Report input: the summary needs status/gaps/errors per item, not full per-item prose
+REPORT_FEEDBACK_MAX_CHARS = 300
+# Long OCR'd answers are compacted before grading; shorter ones are sent as written
+ANSWER_COMPACT_MIN_CHARS = 2000
+GRADING_MAX_WORKERS = 8
+# Per-request timeouts (s): a stalled call is cut off and retried by with_backoff instead of blocking Step 5
+GRADING_TIMEOUT = 45
+REPORT_TIMEOUT = 90
+# Batch API: submissions with at least BATCH_THRESHOLD items are graded asynchronously
+BATCH_THRESHOLD = 20
 
 GRADING_SYSTEM_PROMPT = """
 Bạn là giáo viên Toán chuyên nghiệp tại Việt Nam với 15 năm kinh nghiệm chấm thi. 
@@ -95,17 +106,26 @@ GRADING_SCHEMA = {
             "description": "true nếu hoàn toàn đúng, false nếu có lỗi"
         }
     },
-    "required": ["knowledge_gaps", "calculation_logic_errors", "llm_feedback", "is_correct"]
+    "required": ["knowledge_gaps", "calculation_logic_errors", "llm_feedback", "is_correct"],
+    "additionalProperties": False
+}
+
+# Why: the parts of the grading request that never change are built once at import, not per call
+GRADING_SYSTEM_MESSAGE = {"role": "system", "content": GRADING_SYSTEM_PROMPT}
+GRADING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "grading_comparison_result",
+        "strict": True,  # Why: guarantees the four keys, so replies are stored without any repair or fallback
+        "schema": GRADING_SCHEMA
+    }
 }
 
 # =====================
 # Client bootstrap
 # =====================
-load_dotenv()
-_api_key = os.getenv("OPENAI_API_KEY")
-if not _api_key:
-    raise RuntimeError("Missing OPENAI_API_KEY")
-_client = OpenAI(api_key=_api_key)
+_client = get_openai_client()
+_create_completion = with_backoff()(throttled(_client.chat.completions.create))
 
 
 # =====================
@@ -129,21 +149,45 @@ class GradingResult:
 
 def grade_with_solution_comparison(question_id: int, student_answer: str) -> Dict[str, Any]:
     """Grade by comparing student answer with standard solution and rubric"""
-    solution = get_solution_by_question(question_id)
+    return _call_grading_ai(_solution_payload(question_id, get_solution_by_question(question_id), student_answer))
+
+def _pair_payload(q: Question, a: SubmissionItem) -> Dict:
+    # Why: q.solution is eager-loaded by get_questions_by_exam, so no per-question SELECT here
+    s = q.solution
+    solution = s and {
+        "solution_text": s.solution_text,
+        "final_answer": s.final_answer,
+        "reasoning_approach": s.reasoning_approach,
+    }
+    return _solution_payload(q.id, solution, a.answer_text)
+
+def _solution_payload(question_id: int, solution: Optional[Dict], student_answer: str) -> Dict:
     if not solution:
         raise ValueError(f"Không tìm thấy lời giải chuẩn cho question_id {question_id}")
     
-    payload = {
+    return {
         "solution_text": solution["solution_text"],          # Hướng logic giải
         "final_answer": solution["final_answer"],            # Đáp án chuẩn
         "reasoning_approach": solution["reasoning_approach"], # BAREM chấm điểm
-        "student_answer": student_answer                     # Bài làm học sinh
+        "student_answer": _compact_answer(student_answer)    # Bài làm học sinh
     }
-    
-    return _call_grading_ai(payload)
 
-def _call_grading_ai(payload: Dict) -> Dict[str, Any]:
-    """Call OpenAI to grade with solution comparison"""
+def _compact_answer(text: Optional[str]) -> str:
+    """For answers over ANSWER_COMPACT_MIN_CHARS, collapse whitespace within lines and drop consecutive duplicate
+    lines (OCR artifacts) to cut input tokens. A blank line between two equal lines keeps both.
+    """
+    text = text or ""
+    if len(text) <= ANSWER_COMPACT_MIN_CHARS:
+        return text
+    lines: List[str] = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not lines or lines[-1] != line:
+            lines.append(line)
+    return "\n".join(lines)
+
+def _grading_request(payload: Dict) -> Dict[str, Any]:
+    """Chat-completion body shared by the live call and the Batch API"""
     user_content = (
         "So sánh bài làm học sinh với lời giải chuẩn và barem chấm điểm:\n\n"
         f"**LỜI GIẢI CHUẨN:**\n{payload['solution_text']}\n\n"
@@ -152,106 +196,160 @@ def _call_grading_ai(payload: Dict) -> Dict[str, Any]:
         f"**BÀI LÀM HỌC SINH:**\n{payload['student_answer']}\n\n"
         "Hãy phân tích và đánh giá theo 3 yếu tố đã nêu trong system prompt."
     )
-    
+    return {
+        "model": MODEL_GRADING,
+        "messages": [GRADING_SYSTEM_MESSAGE, {"role": "user", "content": user_content}],
+        "temperature": TEMPERATURE,
+        "response_format": GRADING_RESPONSE_FORMAT
+        # Không dùng reasoning_effort (no reasoning theo yêu cầu)
+    }
+
+def _call_grading_ai(payload: Dict) -> Dict[str, Any]:
+    """Call OpenAI to grade with solution comparison"""
+    return _try_grading_ai(payload)[0]
+
+def _try_grading_ai(payload: Dict) -> Tuple[Dict[str, Any], bool]:
+    """Return (grading_data, ok); ok is False when grading_data is the error placeholder."""
     try:
-        resp = _client.chat.completions.create(
-            model=MODEL_GRADING,
-            messages=[
-                {"role": "system", "content": GRADING_SYSTEM_PROMPT},
-                {"role": "user", "content": user_content}
-            ],
-            temperature=TEMPERATURE,
-            response_format={
-                "type": "json_schema", 
-                "json_schema": {
-                    "name": "grading_comparison_result",
-                    "schema": GRADING_SCHEMA
-                }
-            }
-            # Không dùng reasoning_effort (no reasoning theo yêu cầu)
-        )
-        
-        return json.loads(resp.choices[0].message.content)
+        resp = _create_completion(**_grading_request(payload), timeout=GRADING_TIMEOUT)
+        return json.loads(resp.choices[0].message.content), True
         
     except Exception as e:
-        return {
-            "knowledge_gaps": ["Không thể phân tích do lỗi hệ thống"],
-            "calculation_logic_errors": [],
-            "llm_feedback": f"Lỗi khi chấm bài: {str(e)}",
-            "is_correct": False
-        }
-
-def grade_submission(submission_id: int) -> List[GradingResult]:
-    """Grade all matched (question, answer) pairs for a submission.
-    Why: single entry point for app.py.
-    """
-    submission = _get_submission(submission_id)
-    if not submission:
-        return []
-
-    exam_id = submission.exam_id
-    questions = db.get_questions_by_exam(exam_id)
-    items = db.get_submission_items(submission_id)
-
-    # Build maps for matching and context
-    q_map_qa, mismatches = _match_pairs(questions, items)
+        return _grading_error(e), False
 
-    results: List[GradingResult] = []
+def _grading_cache_key(payload: Dict) -> str:
+    # Why: the whole request (model, prompt, schema, solution) is hashed, so any change to them misses the cache
+    answer = " ".join(payload["student_answer"].split())
+    request = _grading_request({**payload, "student_answer": answer})
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
 
-    # Process by order_index groups to preserve dependency chain
-    for order_index in sorted(q_map_qa.keys()):
-        pairs = q_map_qa[order_index]
-        # Sort by student's position (already preserved in _match_pairs)
-        context_stack: List[Tuple[Question, SubmissionItem]] = []
-        
-        for q, a in pairs:
-            if not (a.answer_text or "").strip():
-                # Tạo grading record cho câu không làm với knowledge_topics từ question
-                _create_missing_grading(q, submission_id)
-                continue
-            
-            ctx = _build_context(order_index, context_stack)
-            reasoning_effort = _get_reasoning_effort(q.difficulty)
-            payload = _make_payload(q, a, ctx)
-
-            # Sử dụng solution comparison grading mới
-            grading_data = grade_with_solution_comparison(q.id, a.answer_text)
-            
-            _save_grading_new(
-                submission_id, 
-                q.id, 
-                grading_data["knowledge_gaps"],
-                grading_data["calculation_logic_errors"], 
-                grading_data["llm_feedback"],
-                grading_data["is_correct"]
-            )
-            
-            results.append(
-                GradingResult(
-                    submission_id=submission_id,
-                    question_id=q.id,
-                    order_index=q.order_index,
-                    part_label=(getattr(q, "part_label", None) or ""),
-                    knowledge_gaps=grading_data["knowledge_gaps"],
-                    calculation_logic_errors=grading_data["calculation_logic_errors"],
-                    llm_feedback=grading_data["llm_feedback"],
-                    is_correct=grading_data["is_correct"],
-                )
-            )
-            # Extend context after grading current item
-            context_stack.append((q, a))
+def _grading_error(e: Exception) -> Dict[str, Any]:
+    return {
+        "knowledge_gaps": ["Không thể phân tích do lỗi hệ thống"],
+        "calculation_logic_errors": [],
+        "llm_feedback": f"Lỗi khi chấm bài: {str(e)}",
+        "is_correct": False
+    }
 
-    # Note: mismatches intentionally ignored here (teacher fixes in Step 3)
-    return results
+def grade_submission(submission_id: int, force: bool = False) -> List[GradingResult]:
+    """Grade all matched (question, answer) pairs for a submission.
+    Why: single entry point for app.py. force=True skips cached gradings and overwrites them with fresh ones.
+    """
+    to_grade = _prepare_grading(submission_id)
+    payloads = [_pair_payload(q, a) for q, a in to_grade]
+    keys = [_grading_cache_key(p) for p in payloads]
+
+    # Why: students often write the same answer; identical (solution, answer) pairs are graded once, across runs too
+    known = {} if force else db.get_cached_gradings(keys)
+    fresh = {k: p for k, p in zip(keys, payloads) if k not in known}
+
+    # Why: each grading call only needs its own solution + answer, so they can overlap
+    workers = max(1, min(GRADING_MAX_WORKERS, len(fresh)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        outcomes = dict(zip(fresh, pool.map(_try_grading_ai, fresh.values())))
+
+    db.save_cached_gradings({k: data for k, (data, ok) in outcomes.items() if ok})
+    known.update({k: data for k, (data, _) in outcomes.items()})
+    return _save_gradings(submission_id, to_grade, [known[k] for k in keys])
+
+def grade_submission_batch(submission_id: int, force: bool = False) -> Optional[str]:
+    """Submit the answered items that are not cached (all of them when force=True) as one OpenAI Batch job.
+    Why: large submissions avoid per-minute rate limits and cost ~50% less; results are collected later.
+    """
+    payloads = {_grading_cache_key(p): p for p in (_pair_payload(q, a) for q, a in _prepare_grading(submission_id))}
+    known = {} if force else db.get_cached_gradings(list(payloads))
+    # Why: the cache key is the custom_id, so identical answers are sent once and collected into the cache
+    requests = {key: _grading_request(p) for key, p in payloads.items() if key not in known}
+    if not requests:
+        return None
+
+    batch_id = submit_chat_batch(_client, requests, "grading.jsonl")
+    db.create_grading_batch(submission_id, batch_id)
+    return batch_id
+
+def collect_grading_batch(submission_id: int) -> Optional[Tuple[List[GradingResult], List[Question]]]:
+    """Save the results of the submission's pending batch job; return (results, questions the batch did not grade).
+    Returns None while it is still running. Ungraded questions keep no new grading, so grading again retries them.
+    """
+    pending = db.get_pending_grading_batch(submission_id)
+    if not pending:
+        return [], []
+
+    outputs = fetch_chat_batch(_client, pending.batch_id)
+    if outputs is None:
+        return None
+
+    fresh = {key: out for key, out in outputs.items() if isinstance(out, dict)}
+    db.save_cached_gradings(fresh)
+
+    # Items may have been re-saved since submission; only keep pairs that are graded now.
+    # Why: answers left out of the batch were already cached when it was submitted
+    to_grade, _ = _collect_pairs(submission_id)
+    keys = [_grading_cache_key(_pair_payload(q, a)) for q, a in to_grade]
+    graded = {**db.get_cached_gradings([key for key in keys if key not in outputs]), **fresh}
+    done = [(pair, key) for pair, key in zip(to_grade, keys) if key in graded]
+    failed = [q for (q, _), key in zip(to_grade, keys) if key not in graded]
+    results = _save_gradings(submission_id, [pair for pair, _ in done], [graded[key] for _, key in done])
+    db.update_grading_batch_status(pending.id, "collected" if done else "failed")
+    return results, failed
+
+def cancel_grading_batch(submission_id: int) -> None:
+    """Cancel the submission's pending batch job so it can be graded live instead."""
+    pending = db.get_pending_grading_batch(submission_id)
+    if pending:
+        cancel_chat_batch(_client, pending.batch_id)
+        db.update_grading_batch_status(pending.id, "cancelled")
+
+def count_llm_pairs(submission_id: int, force: bool = False) -> int:
+    """Number of grading calls grade_submission would make; blank (and unless force, already-cached) answers need none."""
+    to_grade, _ = _collect_pairs(submission_id)
+    keys = {_grading_cache_key(_pair_payload(q, a)) for q, a in to_grade}
+    return len(keys) if force else len(keys - db.get_cached_gradings(list(keys)).keys())
 
 
 def build_final_report(submission_id: int) -> str:
     """Build a student-friendly Markdown summary from existing gradings and save to DB.
     """
+    return "".join(build_final_report_stream(submission_id))
+
+def build_final_report_stream(submission_id: int) -> Iterator[str]:
+    """Same as build_final_report but yields Markdown chunks as the model produces them.
+    Why: st.write_stream shows the report from the first token instead of after the full generation.
+    """
+    messages = _report_messages(submission_id)
+    chunks: List[str] = []
+    try:
+        stream = _create_completion(
+            model=MODEL_GRADING,
+            messages=messages,
+            temperature=0.2,
+            timeout=REPORT_TIMEOUT,
+            stream=True
+        )
+        for event in stream:
+            piece = event.choices[0].delta.content if event.choices else None
+            if piece:
+                chunks.append(piece)
+                yield piece
+    except Exception:
+        yield ("\n\n" if chunks else "") + "Không thể tạo báo cáo do lỗi hệ thống."
+        return
+
+    # Save report to database once the stream is complete
+    try:
+        db.save_submission_report(submission_id, "".join(chunks))
+    except Exception as e:
+        print(f"Warning: Could not save report to DB: {e}")
+
+def _report_messages(submission_id: int) -> List[Dict[str, str]]:
+    # Why: column tuples only; the report needs a handful of fields, not two hydrated ORM objects per row
     with db.get_session() as session:
         grades = (
-            session.query(Grading, Question)
-            .join(Question, Grading.question_id == Question.id)
+            session.query(
+                Question.order_index, Question.part_label,
+                Grading.knowledge_gaps, Grading.calculation_logic_errors, Grading.llm_feedback, Grading.is_correct,
+            )
+            .join(Grading, Grading.question_id == Question.id)
             .filter(Grading.submission_id == submission_id)
             .order_by(Question.order_index, Question.id)
             .all()
@@ -259,14 +357,13 @@ def build_final_report(submission_id: int) -> str:
 
     # Prepare compact input for LLM
     compact = []
-    for g, q in grades:
+    for g in grades:
         compact.append({
-            "order_index": q.order_index,
-            "part_label": getattr(q, "part_label", None) or "",
-            "question_text": (q.question_text or "")[:CTX_MAX_CHARS_QUESTION],
-            "knowledge_gaps": _safe_json_loads(g.knowledge_gaps) or [],
-            "calculation_logic_errors": _safe_json_loads(g.calculation_logic_errors) or [],
-            "llm_feedback": (g.llm_feedback or ""),
+            "order_index": g.order_index,
+            "part_label": g.part_label or "",
+            "knowledge_gaps": g.knowledge_gaps,
+            "calculation_logic_errors": g.calculation_logic_errors,
+            "llm_feedback": (g.llm_feedback or "")[:REPORT_FEEDBACK_MAX_CHARS],
             "is_correct": bool(g.is_correct),
         })
 
@@ -280,29 +377,12 @@ def build_final_report(submission_id: int) -> str:
 
     user = (
         "Dưới đây là danh sách kết quả chấm theo từng ý. Hãy biên tập thành báo cáo tổng hợp cho học sinh.\n\n"
-        + json.dumps(compact, ensure_ascii=False)
+        + json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
     )
-
-    try:
-        resp = _client.chat.completions.create(
-            model=MODEL_GRADING,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user}
-            ],
-            temperature=0.2
-        )
-        report_content = resp.choices[0].message.content
-        
-        # Save report to database
-        try:
-            db.save_submission_report(submission_id, report_content)
-        except Exception as e:
-            print(f"Warning: Could not save report to DB: {e}")
-        
-        return report_content
-    except Exception:
-        return "Không thể tạo báo cáo do lỗi hệ thống."
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
+    ]
 
 def get_or_generate_report(submission_id: int) -> str:
     """Get saved report from DB, or generate new one if not exists"""
@@ -319,20 +399,75 @@ def get_or_generate_report(submission_id: int) -> str:
 # Internals
 # =====================
 
-def _get_submission(submission_id: int) -> Optional[Submission]:
+def _prepare_grading(submission_id: int) -> List[Tuple[Question, SubmissionItem]]:
+    """Record blank answers right away; return the answered pairs that still need the LLM."""
+    to_grade, blank = _collect_pairs(submission_id)
+    # Tạo grading record cho câu không làm với knowledge_topics từ question
+    _upsert_gradings(submission_id, [(q.id, _missing_grading(q)) for q in blank])
+    return to_grade
+
+
+def _collect_pairs(submission_id: int) -> Tuple[List[Tuple[Question, SubmissionItem]], List[Question]]:
+    """Return (answered pairs, questions left blank) in grading order."""
+    exam_id = _get_exam_id(submission_id)
+    if exam_id is None:
+        return [], []
+
+    questions = db.get_questions_by_exam(exam_id)
+    items = db.get_submission_items(submission_id)
+
+    # Build maps for matching and context
+    q_map_qa, mismatches = _match_pairs(questions, items)
+
+    to_grade: List[Tuple[Question, SubmissionItem]] = []
+    blank: List[Question] = []
+
+    # Process by order_index groups to preserve dependency chain
+    for order_index in sorted(q_map_qa.keys()):
+        # Sort by student's position (already preserved in _match_pairs)
+        for q, a in q_map_qa[order_index]:
+            if not (a.answer_text or "").strip():
+                blank.append(q)
+                continue
+            to_grade.append((q, a))
+
+    # Note: mismatches intentionally ignored here (teacher fixes in Step 3)
+    return to_grade, blank
+
+
+def _save_gradings(submission_id: int, to_grade: List[Tuple[Question, SubmissionItem]], graded: List[Dict]) -> List[GradingResult]:
+    _upsert_gradings(submission_id, [(q.id, grading_data) for (q, _), grading_data in zip(to_grade, graded)])
+
+    results: List[GradingResult] = []
+    for (q, a), grading_data in zip(to_grade, graded):
+        results.append(
+            GradingResult(
+                submission_id=submission_id,
+                question_id=q.id,
+                order_index=q.order_index,
+                part_label=q.part_label or "",
+                knowledge_gaps=grading_data["knowledge_gaps"],
+                calculation_logic_errors=grading_data["calculation_logic_errors"],
+                llm_feedback=grading_data["llm_feedback"],
+                is_correct=grading_data["is_correct"],
+            )
+        )
+    return results
+
+
+def _get_exam_id(submission_id: int) -> Optional[int]:
+    # Why: only exam_id is needed; skip hydrating the submission's full OCR text
     with db.get_session() as session:
-        return session.query(Submission).filter(Submission.id == submission_id).first()
+        return session.query(Submission.exam_id).filter(Submission.id == submission_id).scalar()
 
 
 def _match_pairs(questions: List[Question], items: List[SubmissionItem]):
     """Return mapping: order_index -> list of (Question, SubmissionItem), mismatches list.
     Why: priority by explicit question_id; else by (order_index, part_label).
     """
-    # Build lookup by (order_index, part_label)
-    q_lookup: Dict[Tuple[int, str], Question] = {}
-    for q in questions:
-        key = (q.order_index, getattr(q, "part_label", None) or "")
-        q_lookup[key] = q
+    # Build lookups by id and by (order_index, part_label)
+    q_by_id: Dict[int, Question] = {q.id: q for q in questions}
+    q_lookup: Dict[Tuple[int, str], Question] = {(q.order_index, q.part_label or ""): q for q in questions}
 
     # Group items by order_index in order of appearance (position)
     pairs_by_order: Dict[int, List[Tuple[Question, SubmissionItem]]] = {}
@@ -342,10 +477,9 @@ def _match_pairs(questions: List[Question], items: List[SubmissionItem]):
         q: Optional[Question] = None
         if getattr(a, "question_id", None):
             # Explicit mapping from Step 3
-            q = next((x for x in questions if x.id == a.question_id), None)
+            q = q_by_id.get(a.question_id)
         else:
-            key = (a.order_index, getattr(a, "part_label", None) or "")
-            q = q_lookup.get(key)
+            q = q_lookup.get((a.order_index, a.part_label or ""))
 
         if q is None:
             mismatches.append(a)
@@ -356,115 +490,34 @@ def _match_pairs(questions: List[Question], items: List[SubmissionItem]):
     return pairs_by_order, mismatches
 
 
-def _build_context(order_index: int, context_stack: List[Tuple[Question, SubmissionItem]]):
-    """Context from previous parts in the same order_index (question+answer)."""
-    ctx = []
-    for q, a in context_stack:
-        if q.order_index != order_index:
-            continue
-        ctx.append({
-            "part_label": getattr(q, "part_label", None) or "",
-            "question_text": (q.question_text or "")[:CTX_MAX_CHARS_QUESTION],
-            "student_answer": (a.answer_text or "")[:CTX_MAX_CHARS_ANSWER],
-        })
-    return ctx
-
-
-def _make_payload(q: Question, a: SubmissionItem, ctx) -> Dict:
-    return {
-        "current": {
-            "order_index": q.order_index,
-            "part_label": getattr(q, "part_label", None) or "",
-            "question_text": (q.question_text or "")[:CTX_MAX_CHARS_QUESTION],
-            "student_answer": (a.answer_text or "")[:CTX_MAX_CHARS_ANSWER],
-        },
-        "context_previous": ctx,
-    }
-
-
-def _get_reasoning_effort(difficulty: Optional[int]) -> str:
-    if difficulty is None:
-        return "medium"
-    try:
-        d = int(difficulty)
-    except Exception:
-        return "medium"
-    if d < 5:
-        return "low"
-    elif 6 <= d <= 8:
-        return "medium"
-    else:
-        return "high"
-
-
-def _call_llm_json_with_openai(payload: Dict, reasoning_effort: str) -> Dict:
-    system = GRADING_SYSTEM_PROMPT
-    user = (
-        "Chấm ý hiện tại dựa trên đề, câu trả lời của học sinh và ngữ cảnh các ý trước đó.\n"
-        "Trả về JSON đúng schema đã định.\n\n"
-        + json.dumps(payload, ensure_ascii=False)
-    )
-
-    try:
-        resp = _client.chat.completions.create(
-            model=MODEL_GRADING,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user}
-            ],
-            temperature=TEMPERATURE,
-            response_format={
-                "type": "json_schema", 
-                "json_schema": {
-                    "name": "grading_result",
-                    "schema": GRADING_SCHEMA
-                }
-            },
-            reasoning_effort=reasoning_effort
-        )
-        
-        return json.loads(resp.choices[0].message.content)
-        
-    except Exception:
-        return {"nhan_xet": "Không thể chấm do lỗi hệ thống", "kien_thuc_hong": []}
-
-
-
-def _save_grading_new(submission_id: int, question_id: int, knowledge_gaps: List[str], 
-                     calculation_logic_errors: List[str], llm_feedback: str, is_correct: bool):
-    knowledge_gaps_json = json.dumps(knowledge_gaps, ensure_ascii=False)
-    calculation_errors_json = json.dumps(calculation_logic_errors, ensure_ascii=False)
-    
-    with db.get_session() as session:
-        row = (
-            session.query(Grading)
-            .filter(Grading.submission_id == submission_id, Grading.question_id == question_id)
-            .first()
-        )
-        if not row:
-            row = Grading(
-                submission_id=submission_id,
-                question_id=question_id,
-                knowledge_gaps=knowledge_gaps_json,
-                calculation_logic_errors=calculation_errors_json,
-                llm_feedback=llm_feedback,
-                is_correct=1 if is_correct else 0,
-                final_score=None,
+def _upsert_gradings(submission_id: int, rows: List[Tuple[int, Dict[str, Any]]]) -> None:
+    """Insert or update one Grading per (question_id, grading_data) in a single transaction."""
+    if not rows:
+        return
+    with db.get_session() as session, session.begin():
+        existing = {
+            g.question_id: g
+            for g in session.query(Grading).filter(
+                Grading.submission_id == submission_id,
+                Grading.question_id.in_([question_id for question_id, _ in rows])
             )
-            session.add(row)
-        else:
-            row.knowledge_gaps = knowledge_gaps_json
-            row.calculation_logic_errors = calculation_errors_json
-            row.llm_feedback = llm_feedback
-            row.is_correct = 1 if is_correct else 0
+        }
+        for question_id, grading_data in rows:
+            row = existing.get(question_id)
+            if not row:
+                row = Grading(submission_id=submission_id, question_id=question_id)
+                session.add(row)
+                existing[question_id] = row
+            row.knowledge_gaps = grading_data["knowledge_gaps"]
+            row.calculation_logic_errors = grading_data["calculation_logic_errors"]
+            row.llm_feedback = grading_data["llm_feedback"]
+            row.is_correct = 1 if grading_data["is_correct"] else 0
             row.final_score = None
-        session.commit()
 
 
-def _create_missing_grading(question: Question, submission_id: int):
-    """Tạo grading record cho câu học sinh không làm, sử dụng knowledge_topics từ question"""
-    # Parse knowledge_topics từ question (JSON string)
-    knowledge_topics = _safe_json_loads(question.knowledge_topics)
+def _missing_grading(question: Question) -> Dict[str, Any]:
+    """Grading data cho câu học sinh không làm, sử dụng knowledge_topics từ question"""
+    knowledge_topics = question.knowledge_topics or []
     
     # Tạo feedback message
     if knowledge_topics:
@@ -473,21 +526,9 @@ def _create_missing_grading(question: Question, submission_id: int):
     else:
         feedback = "Học sinh không làm câu này."
     
-    # Lưu grading record với knowledge_gaps = knowledge_topics
-    _save_grading_new(
-        submission_id=submission_id,
-        question_id=question.id,
-        knowledge_gaps=knowledge_topics,  # Sử dụng knowledge_topics từ question
-        calculation_logic_errors=[],      # Rỗng vì không có tính toán
-        llm_feedback=feedback,
-        is_correct=False                  # Không đúng vì không làm
-    )
-
-
-def _safe_json_loads(s: Optional[str]):
-    if not s:
-        return []
-    try:
-        return json.loads(s)
-    except Exception:
-        return []
+    return {
+        "knowledge_gaps": knowledge_topics,   # Sử dụng knowledge_topics từ question
+        "calculation_logic_errors": [],       # Rỗng vì không có tính toán
+        "llm_feedback": feedback,
+        "is_correct": False                   # Không đúng vì không làm
+    }
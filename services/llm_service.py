@@ -2,26 +2,31 @@
 
 from __future__ import annotations
 
-import os
 import json
+import hashlib
 import logging
 from typing import List, Dict, Any
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
-from dotenv import load_dotenv
-from openai import OpenAI
+from utils.openai_client import get_openai_client
+from utils.retry import with_backoff
+from utils.throttle import throttled
 
 # Setup logger
 logger = logging.getLogger(__name__)
 
 # ---------- Constants
-API_KEY_ENV = "OPENAI_API_KEY"
 MODEL_NAME = "o4-mini-2025-04-16"
 SEGMENT_MODEL = "gpt-4.1-mini"
 TEMPERATURE = 0.1
+SEGMENT_MAX_WORKERS = 4
+# Per-request timeouts (s); analysis uses a reasoning model, so it gets more headroom
+ANALYZE_TIMEOUT = 180
+SEGMENT_TIMEOUT = 90
 
-load_dotenv()
-_client = OpenAI(api_key=os.getenv(API_KEY_ENV))
+_client = get_openai_client()
+_create_completion = with_backoff()(throttled(_client.chat.completions.create))
 
 # ---------- Fixed System Prompt (adapted from user's instruction)
 SYSTEM_PROMPT_ANALYZE = """
@@ -177,28 +182,35 @@ SEGMENT_SCHEMA = {
     "required": ["items"]
 }
 
+# Why: persisted result caches key on this so a model/prompt/schema change never replays stale output
+LLM_CONFIG_SIG = hashlib.sha256(repr((
+    MODEL_NAME, SEGMENT_MODEL, TEMPERATURE,
+    SYSTEM_PROMPT_ANALYZE, SYSTEM_PROMPT_SEGMENT, ANALYZE_SCHEMA, SEGMENT_SCHEMA,
+)).encode("utf-8")).hexdigest()
+
 # ---------- Public APIs
 def analyze_exam(exam_text: str) -> List[Dict[str, Any]]:
-    logger.info(f"=== ANALYZE EXAM START ===")
-    logger.info(f"Input text length: {len(exam_text)} chars")
-    logger.info(f"Input text preview: {exam_text[:200]}...")
+    logger.info("=== ANALYZE EXAM START ===")
+    logger.info("Input text length: %d chars", len(exam_text))
+    logger.debug("Input text preview: %.200s...", exam_text)
     
     prompt = (
         "Phân tích văn bản đề thi sau và TRẢ VỀ DUY NHẤT JSON theo lược đồ đã nêu.\n\n"
         f"{exam_text.strip()}"
     )
     
-    logger.info(f"Prompt length: {len(prompt)} chars")
-    logger.info(f"Using model: {MODEL_NAME}")
+    logger.info("Prompt length: %d chars", len(prompt))
+    logger.info("Using model: %s", MODEL_NAME)
     
     try:
-        resp = _client.chat.completions.create(
+        resp = _create_completion(
             model=MODEL_NAME,
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT_ANALYZE},
                 {"role": "user", "content": prompt}
             ],
             max_completion_tokens=14000,
+            timeout=ANALYZE_TIMEOUT,
             response_format={
                 "type": "json_schema",
                 "json_schema": {
@@ -209,31 +221,32 @@ def analyze_exam(exam_text: str) -> List[Dict[str, Any]]:
             #reasoning_effort="low"
         )
         
-        logger.info(f"API Response received")
+        logger.info("API Response received")
         if hasattr(resp, 'usage') and resp.usage:
-            logger.info(f"Token usage: {resp.usage}")
+            logger.info("Token usage: %s", resp.usage)
         
         raw_content = resp.choices[0].message.content
-        logger.info(f"Raw response length: {len(raw_content)} chars")
-        logger.info(f"Raw response: {raw_content}")
+        logger.info("Raw response length: %d chars", len(raw_content))
+        logger.debug("Raw response: %s", raw_content)
         
         data = json.loads(raw_content)
-        logger.info(f"JSON parsed successfully")
-        logger.info(f"Parsed data keys: {list(data.keys())}")
+        logger.info("JSON parsed successfully")
+        logger.debug("Parsed data keys: %s", list(data))
         
         if "questions" in data:
-            logger.info(f"Number of questions found: {len(data['questions'])}")
-            for i, q in enumerate(data['questions'][:3]):  # Log first 3 questions
-                logger.info(f"Question {i+1}: {q}")
+            logger.info("Number of questions found: %d", len(data["questions"]))
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, q in enumerate(data['questions'][:3]):  # Log first 3 questions
+                    logger.debug("Question %d: %s", i + 1, q)
         else:
-            logger.warning(f"No 'questions' key in response: {data}")
+            logger.warning("No 'questions' key in response: %s", data)
             
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        logger.error(f"Raw content causing error: {raw_content}")
+        logger.error("JSON decode error: %s", e)
+        logger.error("Raw content causing error: %s", raw_content)
         return []
     except Exception as e:
-        logger.error(f"API call error: {e}")
+        logger.error("API call error: %s", e)
         return []
     
     out: List[Dict[str, Any]] = []
@@ -246,9 +259,9 @@ def analyze_exam(exam_text: str) -> List[Dict[str, Any]]:
             "knowledge_topics": [str(x).strip() for x in (it.get("knowledge_topics") or [])][:4],
         }
         out.append(question_item)
-        logger.debug(f"Processed question: {question_item}")
+        logger.debug("Processed question: %s", question_item)
         
-    logger.info(f"=== ANALYZE EXAM END === Returning {len(out)} questions")
+    logger.info("=== ANALYZE EXAM END === Returning %d questions", len(out))
     return out
 
 def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
@@ -261,8 +274,42 @@ def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
     # Create skeleton with pre-populated structure
     skeleton = create_submission_skeleton(questions)
     
-    logger.info(f"Created skeleton with {len(skeleton)} items")
-    
+    logger.info("Created skeleton with %d items", len(skeleton))
+    return _fill_skeleton(skeleton, submission_text)
+
+def segment_submission_batch(questions: List, submission_text: str) -> Dict[str, Any]:
+    """Like segment_submission, but fills each BÀI LỚN (order_index group) in its own concurrent call."""
+    if not submission_text or not submission_text.strip():
+        logger.warning("Submission text is empty. Returning empty segment list.")
+        return {"items": []}
+
+    # Why: output decoding dominates latency; smaller skeletons in parallel finish sooner
+    groups: Dict[int, List[Dict[str, Any]]] = {}
+    for it in create_submission_skeleton(questions):
+        groups.setdefault(it["order_index"], []).append(it)
+
+    workers = max(1, min(SEGMENT_MAX_WORKERS, len(groups)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda g: _fill_skeleton(g, submission_text), groups.values()))
+
+    # Why: one failed group must not cost the others; retry it alone, then keep its blank skeleton and report it
+    items: List[Dict[str, Any]] = []
+    failed_groups: List[int] = []
+    for (order_index, group), result in zip(groups.items(), results):
+        if len(result.get("items", [])) != len(group):
+            logger.warning("Segmentation of group %s failed; retrying it alone", order_index)
+            result = _fill_skeleton(group, submission_text)
+        if len(result.get("items", [])) == len(group):
+            items.extend(result["items"])
+        else:
+            logger.error("Segmentation of group %s failed again; leaving its answers empty", order_index)
+            failed_groups.append(order_index)
+            items.extend(group)
+
+    logger.info("Segmented %d groups concurrently into %d items", len(groups), len(items))
+    return {"items": items, "failed_groups": failed_groups}
+
+def _fill_skeleton(skeleton: List[Dict[str, Any]], submission_text: str) -> Dict[str, Any]:
     user_msg = (
         "Dưới đây là (1) SKELETON có sẵn cấu trúc và (2) toàn văn bài làm. "
         "Hãy điền answer_text cho từng item trong skeleton và trả về JSON. Nếu như không tìm được câu tương ứng (tức là học sinh không làm bài thì phần answer_text để rỗng). \n\n"
@@ -272,7 +319,7 @@ def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
             
     raw_content = "" # Khởi tạo biến để truy cập được trong khối except
     try:
-        resp = _client.chat.completions.create(
+        resp = _create_completion(
             model=SEGMENT_MODEL,
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT_SEGMENT},
@@ -280,6 +327,7 @@ def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
             ],
             max_tokens=10000,
             temperature=0.1,
+            timeout=SEGMENT_TIMEOUT,
             response_format={
                 "type": "json_schema",
                 "json_schema": {
@@ -290,7 +338,7 @@ def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
         )
         
         raw_content = resp.choices[0].message.content
-        logger.info(f"API response for segmentation received. Length: {len(raw_content)} chars.")
+        logger.info("API response for segmentation received. Length: %d chars.", len(raw_content))
         
         # 1. KIỂM TRA CHUỖI RỖNG: Nếu rỗng, trả về dictionary rỗng hợp lệ
         if not raw_content or not raw_content.strip():
@@ -301,11 +349,11 @@ def segment_submission(questions: List, submission_text: str) -> Dict[str, Any]:
         return json.loads(raw_content)
 
     except json.JSONDecodeError as e:
-        logger.error(f"JSONDecodeError during segmentation: {e}")
-        logger.error(f"Raw content that caused the error: {raw_content}")
+        logger.error("JSONDecodeError during segmentation: %s", e)
+        logger.error("Raw content that caused the error: %s", raw_content)
         # Trả về dictionary rỗng hợp lệ khi JSON không đúng định dạng
         return {"items": []}
     except Exception as e:
-        logger.error(f"An unexpected error occurred during segmentation API call: {e}")
+        logger.error("An unexpected error occurred during segmentation API call: %s", e)
         # Trả về dictionary rỗng hợp lệ cho mọi lỗi khác
         return {"items": []}
\ No newline at end of file
@@ -1,19 +1,45 @@
 # services/ocr_service.py
 from __future__ import annotations
 
-import os
+import io
+import re
+import bisect
+import hashlib
 import logging
-from typing import List
+from typing import List, Tuple, Union
+from itertools import accumulate
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI
-from dotenv import load_dotenv
 import base64
-load_dotenv()
+from PIL import Image, ImageOps, ImageStat
+
+from utils.openai_client import get_openai_client
+from utils.retry import with_backoff
+from utils.throttle import throttled
+
 # -------------------- Constants (single source of truth)
-OPENAI_API_KEY_ENV = "OPENAI_API_KEY"
 OCR_MODEL = "gpt-4.1-mini-2025-04-14"
 TEMPERATURE = 0.0
+OCR_MAX_WORKERS = 4
+PAGE_SEPARATOR = "\n\n---\n\n"
+# The vision model downsizes to fit 2048px anyway; shrinking first keeps phone photos from uploading ~10 MB of base64
+OCR_MAX_SIDE = 2048
+OCR_JPEG_QUALITY = 85
+# Blank-page prefilter: skip OCR only for a page that is unmistakably empty paper; anything doubtful goes to OCR.
+# Paper tone is a bright percentile (not the median) so a page on a dark desk or a chalkboard is never "paper";
+# blank additionally needs the frame mostly near-paper, low variance and fewer than BLANK_MIN_INK_PIXELS ink pixels
+# at 1024px (thin pencil strokes survive the downscale, dust specks stay below the count).
+BLANK_CHECK_SIDE = 1024
+BLANK_PAPER_PERCENTILE = 0.95
+BLANK_MIN_PAPER_LEVEL = 160
+BLANK_PAPER_TOLERANCE = 24
+BLANK_MIN_PAPER_FRACTION = 0.98
+BLANK_MAX_STDDEV = 12
+BLANK_MIN_INK_CONTRAST = 48
+BLANK_MIN_INK_PIXELS = 24
+# Why: "" already marks a failed page (not cached, retried), so a blank page needs its own text
+BLANK_PAGE_TEXT = "(Trang trống)"
 
 # Heuristics for math wrapping
 MATH_HINT_TOKENS = (
@@ -21,6 +47,7 @@ MATH_HINT_TOKENS = (
     "\\sin", "\\cos", "\\tan", "\\left", "\\right",
 )
 INLINE_SYMBOLS = ("^", "_")
+MATHSY_CHARS = "=+-/*()[]{}<>\\"
 DISPLAY_WRAP = "$$"
 INLINE_WRAP = "$"
 
@@ -50,14 +77,60 @@ LÀM SẠCH
 - Giữ xuống dòng/đoạn văn hợp lý; giữ dấu câu và khoảng trắng tự nhiên.
 """
 
+EXAM_USER_MSG = "Hãy chép lại TRANG ĐỀ THI này. Tuân thủ nghiêm các quy tắc LaTeX và delimiter đã nêu."
+SUBMISSION_USER_MSG = (
+    "Đây là BÀI LÀM của học sinh. Hãy chép lại nguyên văn, tuân thủ quy tắc LaTeX và delimiter đã nêu. "
+    "Nếu phát hiện dòng ghi tên học sinh (ví dụ: 'Họ và tên: ...', 'Họ tên: ...', 'Name: ...'), hãy GIỮ NGUYÊN dòng đó."
+)
+
+# Why: persisted OCR caches key on this so a model/prompt/preprocessing change never replays stale text
+OCR_CONFIG_SIG = hashlib.sha256(repr((
+    OCR_MODEL, TEMPERATURE, SYSTEM_PROMPT_OCR, EXAM_USER_MSG, SUBMISSION_USER_MSG,
+    OCR_MAX_SIDE, OCR_JPEG_QUALITY, BLANK_CHECK_SIDE, BLANK_PAPER_PERCENTILE, BLANK_MIN_PAPER_LEVEL, BLANK_PAPER_TOLERANCE,
+    BLANK_MIN_PAPER_FRACTION, BLANK_MAX_STDDEV, BLANK_MIN_INK_CONTRAST, BLANK_MIN_INK_PIXELS, BLANK_PAGE_TEXT,
+    MATH_HINT_TOKENS, INLINE_SYMBOLS, MATHSY_CHARS, DISPLAY_WRAP, INLINE_WRAP,
+)).encode("utf-8")).hexdigest()
+
+# (raw bytes or a zero-copy memoryview, mime type) of one uploaded page
+ImageBytes = Tuple[Union[bytes, memoryview], str]
+
 # -------------------- Logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # -------------------- Helpers
-def _encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+_MATH_HINT_RE = re.compile("|".join(map(re.escape, MATH_HINT_TOKENS)))
+_DROP_MATHSY = str.maketrans("", "", MATHSY_CHARS)
+
+def _encode_image(data: Union[bytes, memoryview]) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+def _prepare_image(data: Union[bytes, memoryview], mime_type: str) -> Tuple[Union[bytes, memoryview], str]:
+    """Downscale pages larger than OCR_MAX_SIDE and re-encode as JPEG; smaller pages pass through untouched."""
+    img = Image.open(io.BytesIO(data))
+    if max(img.size) <= OCR_MAX_SIDE:
+        return data, mime_type
+    img.draft("RGB", (OCR_MAX_SIDE, OCR_MAX_SIDE))  # Why: JPEG decodes at a reduced DCT scale, much faster
+    # Why: re-encoding drops EXIF, so bake the phone's orientation into the pixels first
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+def _is_blank_page(data: Union[bytes, memoryview]) -> bool:
+    img = Image.open(io.BytesIO(data))
+    img.draft("L", (BLANK_CHECK_SIDE, BLANK_CHECK_SIDE))
+    gray = img.convert("L")
+    gray.thumbnail((BLANK_CHECK_SIDE, BLANK_CHECK_SIDE))
+    hist = gray.histogram()
+    total = sum(hist)
+    paper = bisect.bisect_left(list(accumulate(hist)), total * BLANK_PAPER_PERCENTILE)
+    if paper < BLANK_MIN_PAPER_LEVEL or ImageStat.Stat(gray).stddev[0] > BLANK_MAX_STDDEV:
+        return False
+    near_paper = sum(hist[max(0, paper - BLANK_PAPER_TOLERANCE):])
+    ink = sum(hist[:max(0, paper - BLANK_MIN_INK_CONTRAST)])
+    return near_paper >= total * BLANK_MIN_PAPER_FRACTION and ink < BLANK_MIN_INK_PIXELS
 
 def _get_image_mime_type(path: str) -> str:
     ext = Path(path).suffix.lower()
@@ -70,49 +143,47 @@ def _get_image_mime_type(path: str) -> str:
     return "image/jpeg"
 
 def _looks_like_formula(line: str) -> bool:
-    # Why: lightweight rule to decide display-math wrapping
+    # Why: lightweight rule to decide display-math wrapping; runs per OCR line, so scans stay in C (regex/translate)
     s = line.strip()
     if not s:
         return False
     if "$" in s:
         return False
-    if any(tok in s for tok in MATH_HINT_TOKENS):
+    if _MATH_HINT_RE.search(s):
         return True
-    if any(sym in s for sym in INLINE_SYMBOLS) and "=" in s:
+    if "=" in s and any(sym in s for sym in INLINE_SYMBOLS):
         return True
-    letters = sum(ch.isalpha() for ch in s)
-    mathsy = sum(ch in "=+-/*()[]{}<>\\" for ch in s)
+    letters = sum(map(str.isalpha, s))
+    mathsy = len(s) - len(s.translate(_DROP_MATHSY))
     return mathsy >= letters and mathsy >= 3
 
 def _ensure_latex_delimiters(text: str) -> str:
     # Why: normalize math lines so Markdown render ổn định
-    lines = text.splitlines()
-    out = []
-    for ln in lines:
-        s = ln.rstrip()
-        if _looks_like_formula(s):
-            out.append(f"{DISPLAY_WRAP}{s}{DISPLAY_WRAP}")
-        else:
-            out.append(s)
-    return "\n".join(out)
+    return "\n".join(map(_wrap_formula_line, text.splitlines()))
+
+def _wrap_formula_line(line: str) -> str:
+    s = line.rstrip()
+    return f"{DISPLAY_WRAP}{s}{DISPLAY_WRAP}" if _looks_like_formula(s) else s
 
 # -------------------- Service
 class OCRService:
     def __init__(self) -> None:
-        api_key = os.getenv(OPENAI_API_KEY_ENV)
-        try:
-            self._client = OpenAI(api_key=api_key)
-        except TypeError as e:
-            # Handle proxy-related initialization issues
-            logger.warning(f"OpenAI client initialization with basic params: {str(e)}")
-            self._client = OpenAI(api_key=api_key)
+        self._client = get_openai_client()
+        self._create_completion = with_backoff()(throttled(self._client.chat.completions.create))
 
     def _ocr_single_image_with_msg(self, image_path: str, user_msg: str) -> str:
-        base64_image = _encode_image(image_path)
-        mime_type = _get_image_mime_type(image_path)
-        
+        with open(image_path, "rb") as image_file:
+            data = image_file.read()
+        return self._ocr_image_bytes(data, _get_image_mime_type(image_path), user_msg, source=image_path)
+
+    def _ocr_image_bytes(self, data: Union[bytes, memoryview], mime_type: str, user_msg: str, source: str = "upload") -> str:
         try:
-            response = self._client.chat.completions.create(
+            if _is_blank_page(data):
+                logger.info("Skipping blank page: %s", source)
+                return BLANK_PAGE_TEXT
+            data, mime_type = _prepare_image(data, mime_type)
+            base64_image = _encode_image(data)
+            response = self._create_completion(
                 model=OCR_MODEL,
                 messages=[
                     {
@@ -140,26 +211,36 @@ class OCRService:
             return _ensure_latex_delimiters(text) if text else ""
             
         except Exception as e:
-            logger.error(f"OCR failed for {image_path}: {str(e)}")
+            logger.error(f"OCR failed for {source}: {str(e)}")
             return ""
 
     # --- OCR cho đề thi (giữ nguyên)
     def ocr_single_image(self, image_path: str) -> str:
-        user_msg = "Hãy chép lại TRANG ĐỀ THI này. Tuân thủ nghiêm các quy tắc LaTeX và delimiter đã nêu."
-        return self._ocr_single_image_with_msg(image_path, user_msg)
+        return self._ocr_single_image_with_msg(image_path, EXAM_USER_MSG)
 
     def ocr_multiple_images(self, image_paths: List[str]) -> str:
-        parts = [self.ocr_single_image(p) for p in image_paths]
-        return "\n\n---\n\n".join(parts)
+        return self._ocr_pages(image_paths, self.ocr_single_image)
 
     # --- OCR cho bài làm học sinh (user message khác)
     def ocr_submission_images(self, image_paths: List[str]) -> str:
-        user_msg = (
-            "Đây là BÀI LÀM của học sinh. Hãy chép lại nguyên văn, tuân thủ quy tắc LaTeX và delimiter đã nêu. "
-            "Nếu phát hiện dòng ghi tên học sinh (ví dụ: 'Họ và tên: ...', 'Họ tên: ...', 'Name: ...'), hãy GIỮ NGUYÊN dòng đó."
-        )
-        parts = [self._ocr_single_image_with_msg(p, user_msg) for p in image_paths]
-        return "\n\n---\n\n".join(parts)
+        return self._ocr_pages(image_paths, lambda p: self._ocr_single_image_with_msg(p, SUBMISSION_USER_MSG))
+
+    # --- OCR trực tiếp từ bytes upload (không cần file tạm)
+    def ocr_single_image_bytes(self, data: Union[bytes, memoryview], mime_type: str) -> str:
+        return self._ocr_image_bytes(data, mime_type, EXAM_USER_MSG)
+
+    def ocr_multiple_images_bytes(self, images: List[ImageBytes]) -> str:
+        return self._ocr_pages(images, lambda img: self.ocr_single_image_bytes(*img))
+
+    def ocr_submission_images_bytes(self, images: List[ImageBytes]) -> str:
+        return self._ocr_pages(images, lambda img: self._ocr_image_bytes(*img, SUBMISSION_USER_MSG))
+
+    def _ocr_pages(self, pages: list, ocr_page) -> str:
+        # Why: pages are independent network-bound calls; map() keeps page order
+        workers = max(1, min(OCR_MAX_WORKERS, len(pages)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(ocr_page, pages))
+        return PAGE_SEPARATOR.join(parts)
 
     def format_math_for_display(self, text: str) -> str:
         # Why: placeholder for future display tweaks
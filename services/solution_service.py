@@ -1,23 +1,47 @@
 from __future__ import annotations
 
-import os
 import json
-from typing import Dict, Any
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Union
+from dataclasses import dataclass, asdict
 
-from dotenv import load_dotenv
-from openai import OpenAI
+from sqlalchemy import and_, select
+
+from utils.openai_batch import fetch_chat_batch, submit_chat_batch
+from utils.openai_client import get_openai_client
+from utils.retry import with_backoff
+from utils.throttle import throttled
 
 from database.db_manager import db
 from database.models import Question, QuestionSolution
 
 # ---------- Constants
-API_KEY_ENV = "OPENAI_API_KEY"
 MODEL_NAME = "o4-mini"
 TEMPERATURE = 1.0
+SOLUTION_MAX_WORKERS = 4
+# Earlier sibling parts sent as context: the first (usually carries the shared data) + the latest ones
+MAX_CONTEXT_PARTS = 3
+SOLUTION_CONTEXT_TEMPLATE = (
+    "Để giải câu hỏi này, hãy xem xét bối cảnh từ các câu hỏi liên quan sau:\n"
+    "--- BỐI CẢNH BẮT ĐẦU ---\n"
+    "{context}\n"
+    "--- BỐI CẢNH KẾT THÚC ---\n\n"
+)
+SOLUTION_USER_TEMPLATE = (
+    "{context}"
+    "Dựa vào bối cảnh trên (nếu có) và nội dung câu hỏi dưới đây, "
+    "hãy tạo hướng logic giải bài và barem chấm điểm:\n\n"
+    "**Câu hỏi cần giải**: {question_text}\n"
+    "**Độ khó**: {difficulty}/10\n"
+    "**Kiến thức liên quan**: {topics}\n\n"
+    "Trả về JSON với 3 trường:\n"
+    "- solution_text: Hướng logic giải (không chi tiết từng bước)\n"
+    "- final_answer: Kết quả cuối cùng\n"
+    "- reasoning_approach: Barem chấm điểm và tiêu chí đánh giá"
+)
 
-load_dotenv()
-_client = OpenAI(api_key=os.getenv(API_KEY_ENV))
+_client = get_openai_client()
+_create_completion = with_backoff()(throttled(_client.chat.completions.create))
 
 # ---------- System Prompt
 SOLUTION_SYSTEM_PROMPT = """
@@ -58,31 +82,25 @@ SOLUTION_SCHEMA = {
     },
     "required": ["solution_text", "final_answer", "reasoning_approach"]
 }
+# Why: identical for every question; built once so each request only allocates its user message
+SOLUTION_SYSTEM_MESSAGE = {"role": "system", "content": SOLUTION_SYSTEM_PROMPT}
+SOLUTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "question_solution",
+        "schema": SOLUTION_SCHEMA
+    }
+}
 
 @dataclass
 class SolutionResult:
+    question_id: int
     order_index: int
     part_label: str
     solution_text: str
     final_answer: str
     reasoning_approach: str
 
-def _get_reasoning_effort(difficulty: int) -> str:
-    if difficulty < 5:
-        return "low"
-    elif 6 <= difficulty <= 8:
-        return "medium" 
-    else:
-        return "high"
-
-def _get_reasoning_effort(difficulty: int) -> str:
-    if difficulty < 5:
-        return "low"
-    elif 6 <= difficulty <= 8:
-        return "medium" 
-    else:
-        return "high"
-
 def _generate_solution_with_context(
     target_question: Question, 
     context_questions: list[Question]
@@ -90,63 +108,38 @@ def _generate_solution_with_context(
     """
     Gọi API OpenAI để giải một câu hỏi với context từ các câu hỏi liên quan.
     """
-    reasoning_effort = _get_reasoning_effort(target_question.difficulty)
-    
-    # Xây dựng phần context cho prompt
+    resp = _create_completion(**_solution_request(target_question, context_questions))
+    return _solution_result(target_question, json.loads(resp.choices[0].message.content))
+
+def _solution_request(target_question: Question, context_questions: list[Question]) -> Dict[str, Any]:
+    """Chat-completion body shared by the live call and the Batch API"""
+    # Why: later parts would otherwise resend every earlier sibling, O(parts²) input tokens per big question
+    if len(context_questions) > MAX_CONTEXT_PARTS:
+        context_questions = context_questions[:1] + context_questions[1 - MAX_CONTEXT_PARTS:]
     context_str = ""
     if context_questions:
-        context_parts = []
-        for q in context_questions:
-            # Sử dụng f-string an toàn hơn để tạo nhãn
-            label = f" {q.part_label}" if q.part_label else ""
-            context_parts.append(f"Câu {q.order_index}{label}: {q.question_text}")
-        
-        # --- ĐÂY LÀ PHẦN ĐÃ SỬA LỖI ---
-        # 1. Join các phần context thành một chuỗi duy nhất trước
-        joined_context = "\n".join(context_parts)
-        
-        # 2. Sau đó, sử dụng f-string với biến đã được tạo
-        context_str = (
-            "Để giải câu hỏi này, hãy xem xét bối cảnh từ các câu hỏi liên quan sau:\n"
-            "--- BỐI CẢNH BẮT ĐẦU ---\n"
-            f"{joined_context}\n"
-            "--- BỐI CẢNH KẾT THÚC ---\n\n"
-        )
+        context_str = SOLUTION_CONTEXT_TEMPLATE.format(context="\n".join(
+            f"Câu {q.order_index}{' ' + q.part_label if q.part_label else ''}: {q.question_text}"
+            for q in context_questions
+        ))
 
-    # Xây dựng prompt hoàn chỉnh
-    prompt = (
-        f"{context_str}"
-        "Dựa vào bối cảnh trên (nếu có) và nội dung câu hỏi dưới đây, "
-        "hãy tạo hướng logic giải bài và barem chấm điểm:\n\n"
-        f"**Câu hỏi cần giải**: {target_question.question_text}\n"
-        f"**Độ khó**: {target_question.difficulty}/10\n"
-        f"**Kiến thức liên quan**: {target_question.knowledge_topics}\n\n"
-        "Trả về JSON với 3 trường:\n"
-        "- solution_text: Hướng logic giải (không chi tiết từng bước)\n"
-        "- final_answer: Kết quả cuối cùng\n"
-        "- reasoning_approach: Barem chấm điểm và tiêu chí đánh giá"
-    )
-    
-    resp = _client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[
-            {"role": "system", "content": SOLUTION_SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=TEMPERATURE,
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "name": "question_solution",
-                "schema": SOLUTION_SCHEMA
-            }
-        },
-        # reasoning_effort=reasoning_effort # Tham số này không tồn tại, giữ ở dạng comment
+    prompt = SOLUTION_USER_TEMPLATE.format(
+        context=context_str,
+        question_text=target_question.question_text,
+        difficulty=target_question.difficulty,
+        topics=", ".join(target_question.knowledge_topics or []),
     )
-    
-    data = json.loads(resp.choices[0].message.content)
-    
+    return {
+        "model": MODEL_NAME,
+        "messages": [SOLUTION_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+        "temperature": TEMPERATURE,
+        "response_format": SOLUTION_RESPONSE_FORMAT,
+        # reasoning_effort: tham số này không tồn tại, giữ ở dạng comment
+    }
+
+def _solution_result(target_question: Question, data: Dict[str, Any]) -> SolutionResult:
     return SolutionResult(
+        question_id=target_question.id,
         order_index=target_question.order_index,
         part_label=target_question.part_label or "",
         solution_text=data["solution_text"],
@@ -157,53 +150,97 @@ def _generate_solution_with_context(
 # THAY ĐỔI 2: Cập nhật hàm `create_and_save_solution` để xây dựng context.
 # Đây là nơi logic chính được thực hiện.
 def create_and_save_solution(question_id: int) -> int:
+    return save_solutions([generate_solution(question_id)])[0]
+
+def generate_solution(question_id: int) -> SolutionResult:
+    """Generate (but do not save) the solution of one question, with its sibling parts as context."""
     with db.get_session() as session:
-        # 1. Lấy câu hỏi mục tiêu
-        target_question = session.query(Question).filter(Question.id == question_id).first()
-        if not target_question:
-            raise ValueError(f"Question with id {question_id} not found")
-        
-        # 2. Lấy tất cả các câu hỏi có cùng order_index để làm context
-        related_questions = session.query(Question).filter(
-            Question.exam_id == target_question.exam_id, # Thêm điều kiện exam_id để chắc chắn
-            Question.order_index == target_question.order_index
-        ).order_by(Question.part_label).all()
-        
-        # 3. Tách ra những câu hỏi đứng trước để làm context
-        context_questions = []
-        for q in related_questions:
-            if q.id == target_question.id:
-                break # Dừng lại khi gặp câu hỏi hiện tại
-            context_questions.append(q)
-            
-        # 4. Gọi hàm sinh lời giải với đầy đủ context
-        solution_result = _generate_solution_with_context(target_question, context_questions)
+        # 1-2. Lấy câu hỏi mục tiêu cùng tất cả các câu có cùng (exam_id, order_index) trong một truy vấn
+        target = select(Question.exam_id, Question.order_index).where(Question.id == question_id).subquery()
+        related_questions = session.query(Question).join(target, and_(
+            Question.exam_id == target.c.exam_id,
+            Question.order_index == target.c.order_index,
+        )).order_by(Question.part_label).all()
+
+    target_question = next((q for q in related_questions if q.id == question_id), None)
+    if not target_question:
+        raise ValueError(f"Question with id {question_id} not found")
         
-        # 5. Lưu kết quả vào CSDL (giữ nguyên logic cũ)
-        existing = session.query(QuestionSolution).filter(
-            QuestionSolution.question_id == question_id
-        ).first()
+    # 3. Tách ra những câu hỏi đứng trước để làm context
+    context_questions = []
+    for q in related_questions:
+        if q.id == target_question.id:
+            break # Dừng lại khi gặp câu hỏi hiện tại
+        context_questions.append(q)
         
-        if existing:
-            existing.order_index = solution_result.order_index
-            existing.part_label = solution_result.part_label
-            existing.solution_text = solution_result.solution_text
-            existing.final_answer = solution_result.final_answer
-            existing.reasoning_approach = solution_result.reasoning_approach
-            session.commit()
-            return existing.id
+    # 4. Gọi hàm sinh lời giải với đầy đủ context
+    # Why: session is already closed, so no pooled connection is held during the LLM call
+    return _generate_solution_with_context(target_question, context_questions)
+
+def generate_solutions(questions: List[Question]) -> Iterator[Tuple[Question, Union[SolutionResult, Exception]]]:
+    """Generate (but do not save) solutions for already-loaded questions, yielding (question, result or error) as each finishes.
+    Why: sibling context comes from the loaded list, so no SELECT per question; callers save once with save_solutions.
+    """
+    with ThreadPoolExecutor(max_workers=SOLUTION_MAX_WORKERS) as pool:
+        futures = {pool.submit(_generate_solution_with_context, q, context): q for q, context in _with_context(questions)}
+        for fut in as_completed(futures):
+            try:
+                yield futures[fut], fut.result()
+            except Exception as e:
+                yield futures[fut], e
+
+def generate_solutions_batch(exam_id: int) -> Optional[str]:
+    """Submit solution generation for every question of the exam as one OpenAI Batch job and return its id.
+    Why: a whole exam costs ~50% less than the live path; results are collected later.
+    """
+    requests = {
+        _batch_key(q): _solution_request(q, context)
+        for q, context in _with_context(db.get_questions_by_exam(exam_id))
+    }
+    if not requests:
+        return None
+    batch_id = submit_chat_batch(_client, requests, "solutions.jsonl")
+    db.create_solution_batch(exam_id, batch_id)
+    return batch_id
+
+def collect_solutions_batch(exam_id: int) -> Optional[Tuple[List[int], List[Question]]]:
+    """Save the solutions of the exam's pending batch job; return (solution ids, questions the batch did not solve).
+    Returns None while it is still running.
+    """
+    pending = db.get_pending_solution_batch(exam_id)
+    if not pending:
+        return [], []
+
+    outputs = fetch_chat_batch(_client, pending.batch_id)
+    if outputs is None:
+        return None
+
+    # Questions may have been re-analyzed since submission; only keep those the batch actually solved
+    results, failed = [], []
+    for q in db.get_questions_by_exam(exam_id):
+        data = outputs.get(_batch_key(q))
+        if isinstance(data, dict):
+            results.append(_solution_result(q, data))
         else:
-            solution = QuestionSolution(
-                question_id=question_id,
-                order_index=solution_result.order_index,
-                part_label=solution_result.part_label,
-                solution_text=solution_result.solution_text,
-                final_answer=solution_result.final_answer,
-                reasoning_approach=solution_result.reasoning_approach
-            )
-            session.add(solution)
-            session.commit()
-            return solution.id
+            failed.append(q)
+    db.update_solution_batch_status(pending.id, "collected" if results else "failed")
+    return (save_solutions(results) if results else []), failed
+
+def _batch_key(q: Question) -> str:
+    return f"q-{q.id}"
+
+def _with_context(questions: List[Question]) -> Iterator[Tuple[Question, List[Question]]]:
+    """Yield (question, earlier sibling parts) exactly as generate_solution builds them, without a query per question."""
+    groups: Dict[int, List[Question]] = {}
+    for q in sorted(questions, key=lambda q: (q.order_index, q.part_label or "")):
+        groups.setdefault(q.order_index, []).append(q)
+    for group in groups.values():
+        for i, q in enumerate(group):
+            yield q, group[:i]
+
+def save_solutions(results: List[SolutionResult]) -> List[int]:
+    """Upsert generated solutions in one transaction; returns ids in input order."""
+    return db.save_solutions_bulk([asdict(r) for r in results])
 
 def get_solution_by_question(question_id: int) -> Dict[str, Any]:
     with db.get_session() as session:
@@ -214,13 +251,27 @@ def get_solution_by_question(question_id: int) -> Dict[str, Any]:
         if not solution:
             return {}
             
-        return {
-            "id": solution.id,
-            "question_id": solution.question_id,
-            "order_index": solution.order_index,
-            "part_label": solution.part_label,
-            "solution_text": solution.solution_text,
-            "final_answer": solution.final_answer,
-            "reasoning_approach": solution.reasoning_approach,
-            "created_at": solution.created_at
-        }
\ No newline at end of file
+        return _solution_to_dict(solution)
+
+def get_solutions_by_exam(exam_id: int) -> Dict[int, Dict[str, Any]]:
+    """All solutions of an exam in one query, keyed by question_id."""
+    with db.get_session() as session:
+        solutions = (
+            session.query(QuestionSolution)
+            .join(Question, QuestionSolution.question_id == Question.id)
+            .filter(Question.exam_id == exam_id)
+            .all()
+        )
+        return {s.question_id: _solution_to_dict(s) for s in solutions}
+
+def _solution_to_dict(solution: QuestionSolution) -> Dict[str, Any]:
+    return {
+        "id": solution.id,
+        "question_id": solution.question_id,
+        "order_index": solution.order_index,
+        "part_label": solution.part_label,
+        "solution_text": solution.solution_text,
+        "final_answer": solution.final_answer,
+        "reasoning_approach": solution.reasoning_approach,
+        "created_at": solution.created_at
+    }
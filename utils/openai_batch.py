@@ -0,0 +1,54 @@
+# utils/openai_batch.py
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, Optional
+
+from openai import OpenAI
+
+from utils.retry import with_backoff
+
+# -------------------- Constants
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_RUNNING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+def submit_chat_batch(client: OpenAI, requests: Dict[str, Dict[str, Any]], filename: str) -> str:
+    """Upload one chat-completion body per custom_id as JSONL, start a Batch job and return its id."""
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False)
+        for custom_id, body in requests.items()
+    ]
+    # Why: the shared client has max_retries=0; retry each step so a transient error does not redo the upload
+    batch_file = with_backoff()(client.files.create)(file=(filename, "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = with_backoff()(client.batches.create)(
+        input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW
+    )
+    return batch.id
+
+def fetch_chat_batch(client: OpenAI, batch_id: str) -> Optional[Dict[str, Any]]:
+    """Parsed JSON reply per custom_id, or the Exception for a request that failed or could not be parsed.
+    Returns None while the job is still running; custom_ids missing from the result got no reply at all.
+    """
+    batch = with_backoff()(client.batches.retrieve)(batch_id)
+    if batch.status in BATCH_RUNNING_STATUSES:
+        return None
+
+    outputs: Dict[str, Any] = {}
+    # Why: requests that failed inside a finished batch are only listed in the error file
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in with_backoff()(client.files.content)(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            try:
+                outputs[row["custom_id"]] = json.loads(row["response"]["body"]["choices"][0]["message"]["content"])
+            except Exception as e:
+                error = row.get("error") or ((row.get("response") or {}).get("body") or {}).get("error")
+                outputs[row["custom_id"]] = RuntimeError(error) if error else e
+    return outputs
+
+def cancel_chat_batch(client: OpenAI, batch_id: str) -> None:
+    with_backoff()(client.batches.cancel)(batch_id)
@@ -0,0 +1,20 @@
+# utils/openai_client.py
+from __future__ import annotations
+
+import os
+import functools
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+# -------------------- Constants
+API_KEY_ENV = "OPENAI_API_KEY"
+
+@functools.lru_cache(maxsize=1)
+def get_openai_client() -> OpenAI:
+    """Process-wide OpenAI client shared by every service.
+    Why: one httpx pool, so warm keep-alive connections are reused across OCR/analyze/solve/grade calls.
+    max_retries=0: with_backoff is the only retry loop.
+    """
+    load_dotenv()
+    return OpenAI(api_key=os.getenv(API_KEY_ENV), max_retries=0)
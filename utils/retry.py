@@ -0,0 +1,46 @@
+# utils/retry.py
+from __future__ import annotations
+
+import time
+import random
+import logging
+import functools
+
+from openai import RateLimitError, APIConnectionError, InternalServerError
+
+# -------------------- Constants
+RETRY_MAX_TRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)  # APITimeoutError is an APIConnectionError
+RATE_LIMIT_HINTS = ("429", "rate limit")
+PERMANENT_ERROR_CODE = "insufficient_quota"  # billing problem: also a 429, but no retry can fix it
+
+logger = logging.getLogger(__name__)
+
+def _is_retryable(exc: Exception, retry_on: tuple) -> bool:
+    msg = str(exc).lower()
+    if getattr(exc, "code", None) == PERMANENT_ERROR_CODE or PERMANENT_ERROR_CODE in msg:
+        return False
+    # Why: some providers/proxies surface throttling only in the message text
+    return isinstance(exc, retry_on) or any(hint in msg for hint in RATE_LIMIT_HINTS)
+
+def with_backoff(max_tries: int = RETRY_MAX_TRIES, base: float = RETRY_BASE_DELAY,
+                 cap: float = RETRY_MAX_DELAY, retry_on: tuple = RETRYABLE_ERRORS):
+    """Retry transient provider errors with capped exponential backoff + jitter.
+    Build the wrapped client with max_retries=0 so this is the only retry loop.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, max_tries + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if attempt == max_tries or not _is_retryable(e, retry_on):
+                        raise
+                    delay = min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                    logger.warning("%s failed (%s); retry %d/%d in %.1fs", fn.__name__, e, attempt, max_tries - 1, delay)
+                    time.sleep(delay)
+        return wrapper
+    return decorator
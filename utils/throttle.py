@@ -0,0 +1,72 @@
+# utils/throttle.py
+from __future__ import annotations
+
+import os
+import time
+import threading
+import functools
+from typing import Any, Dict, List, Optional
+
+# -------------------- Constants
+RPM_ENV = "OPENAI_RPM"
+TPM_ENV = "OPENAI_TPM"
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 765  # one high-detail 512px tile + base cost
+
+class RateLimiter:
+    """Thread-safe RPM/TPM token buckets, each refilled continuously up to one minute's budget."""
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        # Why: a limit of 0 means "not enforced", so only configured buckets are tracked
+        self._limits = {name: limit for name, limit in (("requests", rpm), ("tokens", tpm)) if limit > 0}
+        self._levels = {name: float(limit) for name, limit in self._limits.items()}
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> None:
+        # Why: a prompt larger than the whole TPM budget must still pass once the bucket is full
+        need = {"requests": 1, "tokens": min(tokens, self._limits.get("tokens", tokens))}
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed, self._stamp = now - self._stamp, now
+                for name, limit in self._limits.items():
+                    self._levels[name] = min(limit, self._levels[name] + elapsed * limit / 60)
+                wait = max((need[name] - self._levels[name]) * 60 / limit for name, limit in self._limits.items())
+                if wait <= 0:
+                    for name in self._limits:
+                        self._levels[name] -= need[name]
+                    return
+            time.sleep(wait)
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limiter() -> Optional[RateLimiter]:
+    rpm = int(os.getenv(RPM_ENV) or 0)
+    tpm = int(os.getenv(TPM_ENV) or 0)
+    return RateLimiter(rpm, tpm) if rpm or tpm else None
+
+def _estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    chars, images = 0, 0
+    for m in messages:
+        content = m.get("content") or ""
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            else:
+                images += 1
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKEN_ESTIMATE
+
+def throttled(fn):
+    """Hold each chat-completion call until the process-wide OPENAI_RPM / OPENAI_TPM budget allows it.
+    Why: concurrent workers otherwise burst into 429s and stall in backoff; a no-op when neither env var is set.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        limiter = get_rate_limiter()
+        if limiter:
+            limiter.acquire(_estimate_tokens(kwargs.get("messages", [])))
+        return fn(*args, **kwargs)
+    return wrapper